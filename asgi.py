@@ -0,0 +1,12 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+from modules.app import create_app
+from modules.lib.asgi import AsgiApplication
+
+# Run with any ASGI server, e.g. uvicorn asgi:application
+application = AsgiApplication(
+    create_app(os.environ.get("APP_NAME", os.path.basename(os.path.dirname(__file__))),
+               os.environ.get("ENV", "DEV"))
+)
@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""In-process stand-in for a PostgreSQL server, used by the benchmarks when no
+real database is given. It implements the small part of the psycopg2
+connection/cursor API used by modules.lib.db and returns synthetic rows, so
+the numbers measure the service code and not the network or the planner.
+"""
+
+import datetime
+import decimal
+import itertools
+
+import psycopg2
+import psycopg2.extensions
+
+
+def synthetic_rows(count):
+    """Rows looking like a typical wide-ish business table."""
+    now = datetime.datetime(2020, 1, 1)
+    return [
+        {
+            "id": i,
+            "name": "company-{}".format(i),
+            "amount": decimal.Decimal(i) / 100,
+            "created_at": now + datetime.timedelta(seconds=i),
+            "active": i % 2 == 0,
+            "meta": {"score": i % 97, "tags": ["a", "b"]},
+        }
+        for i in range(count)
+    ]
+
+
+class StandinCursor:
+    def __init__(self, connection, name=None, cursor_factory=None):
+        self.connection = connection
+        self.name = name
+        self.as_dict = cursor_factory is not None
+        self.itersize = 2000
+        self.rowcount = -1
+        self.description = None
+        self._rows = iter(())
+
+    def execute(self, query, params=None):
+        self.connection.status = psycopg2.extensions.TRANSACTION_STATUS_INTRANS
+        limit = len(self.connection.table)
+        if isinstance(params, dict) and "limit" in params:
+            limit = min(int(params["limit"]), limit)
+        if query.lstrip().upper().startswith(("SELECT", "WITH", "EXECUTE")):
+            rows = self.connection.table[:limit]
+        else:
+            rows = []
+        self.rowcount = len(rows)
+        self.description = [(k,) for k in rows[0]] if rows else None
+        self._rows = iter(rows if self.as_dict else [tuple(r.values()) for r in rows])
+
+    def mogrify(self, query, params=None):
+        return query.encode("utf-8") if isinstance(query, str) else query
+
+    def fetchone(self):
+        return next(self._rows, None)
+
+    def fetchmany(self, size=None):
+        return list(itertools.islice(self._rows, size or self.itersize))
+
+    def fetchall(self):
+        return list(self._rows)
+
+    def __iter__(self):
+        return self._rows
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class StandinConnection:
+    encoding = "UTF8"
+
+    def __init__(self, table):
+        self.table = table
+        self.closed = 0
+        self.autocommit = False
+        self.status = psycopg2.extensions.TRANSACTION_STATUS_IDLE
+
+    def cursor(self, name=None, cursor_factory=None):
+        return StandinCursor(self, name, cursor_factory)
+
+    def commit(self):
+        self.status = psycopg2.extensions.TRANSACTION_STATUS_IDLE
+
+    def rollback(self):
+        self.status = psycopg2.extensions.TRANSACTION_STATUS_IDLE
+
+    def get_transaction_status(self):
+        return self.status
+
+    def close(self):
+        self.closed = 1
+
+
+def install(row_count=10000):
+    """Replace psycopg2.connect by the stand-in, serving row_count synthetic rows."""
+    table = synthetic_rows(row_count)
+    psycopg2.connect = lambda *args, **kwargs: StandinConnection(table)
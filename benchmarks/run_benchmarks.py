@@ -0,0 +1,200 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Throughput and micro benchmarks of the service.
+
+The app is built with create_app and the LOCAL config. Without --dsn, the
+database is the in-process stand-in of pg_standin.py; with --dsn
+("host=... user=... password=... dbname=..."), a real (throwaway) Postgres
+is used and the synthetic route reads generate_series.
+
+    python benchmarks/run_benchmarks.py --output bench_output.json
+
+Results are written as JSON so runs on two commits can be compared.
+"""
+
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import threading
+import time
+import timeit
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+DB_KEY = "bench"
+STANDIN_QUERY = "SELECT * FROM bench_rows LIMIT %(limit)s"
+POSTGRES_QUERY = """
+    SELECT i AS id, 'company-' || i AS name, i / 100.0 AS amount, now() AS created_at,
+           i % 2 = 0 AS active, jsonb_build_object('score', i % 97) AS meta
+    FROM generate_series(1, %(limit)s) AS i
+"""
+
+
+def build_app(dsn, row_count):
+    from flask import Blueprint, jsonify, request
+
+    from modules import flask_settings
+
+    if dsn:
+        params = dict(item.split("=", 1) for item in dsn.split())
+        database = {"HOST": params.get("host", "localhost"), "USER": params.get("user", "postgres"),
+                    "PASSWORD": params.get("password", ""), "NAME": params.get("dbname", "postgres")}
+        query = POSTGRES_QUERY
+    else:
+        import pg_standin
+        pg_standin.install(row_count)
+        database = {"HOST": "standin", "USER": "bench", "PASSWORD": "", "NAME": "bench"}
+        query = STANDIN_QUERY
+    database["POOL"] = {"MIN_SIZE": 1, "MAX_SIZE": 64}
+
+    # LOCAL config, rooted at this checkout whatever the current directory
+    flask_settings.LocalConfig.BASE_DIR = os.path.dirname(ROOT)
+    flask_settings.LocalConfig.DATABASE = {DB_KEY: database}
+    flask_settings.LocalConfig.DEBUG = False
+
+    from modules.app import create_app
+    from modules.lib import db
+
+    app = create_app(os.path.basename(ROOT), "LOCAL")
+
+    blueprint_bench = Blueprint("blueprint_bench", __name__)
+
+    @blueprint_bench.route("/bench/rows", methods=["GET"])
+    def r_bench_rows():
+        limit = int(request.args.get("limit", 100))
+        return jsonify(db.execute_query_and_return_output(DB_KEY, query, {"limit": limit}, fetch_all=True))
+
+    app.register_blueprint(blueprint_bench)
+    return app, query
+
+
+def drive(app, path, concurrency, requests_per_worker):
+    """Hit path from concurrency threads, each with its own test client."""
+    latencies = []
+    errors = [0]
+    lock = threading.Lock()
+
+    def worker():
+        client = app.test_client()
+        local = []
+        for _ in range(requests_per_worker):
+            started = time.perf_counter()
+            response = client.get(path)
+            local.append(time.perf_counter() - started)
+            if response.status_code >= 400:
+                with lock:
+                    errors[0] += 1
+        with lock:
+            latencies.extend(local)
+
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    return {
+        "path": path,
+        "concurrency": concurrency,
+        "requests": len(latencies),
+        "errors": errors[0],
+        "requests_per_second": len(latencies) / elapsed,
+        "latency_ms": {
+            "mean": statistics.mean(latencies) * 1000,
+            "p50": latencies[int(len(latencies) * 0.50)] * 1000,
+            "p95": latencies[min(int(len(latencies) * 0.95), len(latencies) - 1)] * 1000,
+            "p99": latencies[min(int(len(latencies) * 0.99), len(latencies) - 1)] * 1000,
+        },
+    }
+
+
+def micro(name, function, number):
+    """Best of 5 runs, in microseconds per call."""
+    best = min(timeit.repeat(function, number=number, repeat=5))
+    return {"name": name, "calls": number, "us_per_call": best / number * 1e6}
+
+
+def micro_benchmarks(app, query, row_count):
+    from modules.lib import db
+    from modules.lib.formatted_output import Output
+    from pg_standin import synthetic_rows
+
+    rows = synthetic_rows(row_count)
+    insert_data = {"id": 1, "name": "company", "amount": 1.5, "meta": {"score": 1}}
+    results = []
+
+    results.append(micro("generate_insert_query", lambda: db.generate_insert_query(
+        "firma", dict(insert_data), returning="id"), 10000))
+    results.append(micro("Output.as_dict[{} rows]".format(row_count),
+                         lambda: Output(status="success", data=rows).as_dict(), 20))
+    with app.app_context():
+        results.append(micro("Output.as_dict+json[{} rows]".format(row_count),
+                             lambda: app.json.dumps(Output(status="success", data=rows).as_dict()), 5))
+        for limit in (1, 100, row_count):
+            results.append(micro("execute_query[fetch_all, {} rows]".format(limit), lambda: db.execute_query(
+                DB_KEY, query, {"limit": limit}, fetch_all=True), 20 if limit > 100 else 500))
+        results.append(micro("execute_query_and_return_output+json[{} rows]".format(row_count),
+                             lambda: app.json.dumps(db.execute_query_and_return_output(
+                                 DB_KEY, query, {"limit": row_count}, fetch_all=True)), 5))
+        results.append(micro("execute_query_and_return_output+json[{} rows, columnar]".format(row_count),
+                             lambda: app.json.dumps(db.execute_query_and_return_output(
+                                 DB_KEY, query, {"limit": row_count}, fetch_all=True, columnar="rows")), 5))
+    return results
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=ROOT).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--dsn", help="Throwaway Postgres to use instead of the in-process stand-in")
+    parser.add_argument("--output", default="bench_output.json", help="JSON file receiving the results")
+    parser.add_argument("--concurrency", default="1,8,32", help="Comma separated concurrency levels")
+    parser.add_argument("--requests", type=int, default=200, help="Requests per worker thread")
+    parser.add_argument("--rows", type=int, default=10000, help="Rows of the large payloads")
+    args = parser.parse_args()
+
+    app, query = build_app(args.dsn, args.rows)
+    paths = ["/hello", "/locate", "/has_doc", "/bench/rows?limit=100"]
+
+    load = []
+    for concurrency in (int(c) for c in args.concurrency.split(",")):
+        for path in paths:
+            result = drive(app, path, concurrency, args.requests)
+            load.append(result)
+            print("{path:<24} c={concurrency:<3} {requests_per_second:>10.1f} req/s  "
+                  "p50={p50:.2f}ms p99={p99:.2f}ms errors={errors}".format(p50=result["latency_ms"]["p50"],
+                                                                          p99=result["latency_ms"]["p99"],
+                                                                          **result))
+
+    micros = micro_benchmarks(app, query, args.rows)
+    for result in micros:
+        print("{name:<40} {us_per_call:>12.1f} us/call".format(**result))
+
+    with open(args.output, "w") as f:
+        json.dump({
+            "commit": git_commit(),
+            "python": platform.python_version(),
+            "database": "postgres" if args.dsn else "standin",
+            "load": load,
+            "micro": micros,
+        }, f, indent=2)
+    print("Results written to {}".format(args.output))
+
+
+if __name__ == "__main__":
+    main()
@@ -2,12 +2,17 @@
 # -*- coding: utf-8 -*-
 
 import importlib
+import json
 import logging
+import time
 
-from flask import Flask, Blueprint, jsonify
-from os import chdir, getcwd, listdir
+from flask import Flask, Blueprint, g, jsonify, request
+from os import getpid, listdir, replace, stat
 from os.path import isfile, join, splitext
-from modules.lib import db
+from modules.lib import aiodb, db, metrics
+from modules.lib.json_provider import AppJSONProvider
+from modules.lib.logs import setup_queued_logging
+from modules.lib.static_cache import StaticAssetCache
 from modules.exceptions.api_error_exception import ApiErrorException
 
 
@@ -18,44 +23,84 @@ ALIAS = {
     "LOCAL": "modules.flask_settings.LocalConfig",
 }
 
+# Bumped when the content of the blueprint manifest changes, so older files are rebuilt
+_BLUEPRINT_MANIFEST_VERSION = 2
+
 
 def create_app(application_name, env):
+    started = time.perf_counter()
 
     app = Flask(__name__)
     app.config.from_object(ALIAS[env])
+    app.json = AppJSONProvider(app)
 
     # Update configuration with the name of the application
     app.config["APP_NAME"] = application_name
     app.config["BASE_DIR"] = join(app.config["BASE_DIR"], application_name)
     db.init_app(app)
+    aiodb.init_app(app)
 
-    # Logger configured here
-    if app.config.get("LOG_DIR"):
-        logging.basicConfig(
-            filename="{}/{}.log".format(app.config.get("LOG_DIR"), application_name),
-            format="%(asctime)s [%(threadName)-10s] - %(levelname)s - "
-                   "%(module)s.%(funcName)s(%(lineno)d): %(message)s",
-            level=logging.DEBUG if app.config.get("DEBUG") else logging.INFO
-        )
-    else:
-        logging.basicConfig(
-            format="%(asctime)s [%(threadName)-10s] - %(levelname)s - "
-                   "%(module)s.%(funcName)s(%(lineno)d): %(message)s",
-            level=logging.DEBUG if app.config.get("DEBUG") else logging.INFO
-        )
+    # Logger configured here: records go through a queue, written by a listener thread
+    app.extensions["log_listener"] = setup_queued_logging(
+        logging.DEBUG if app.config.get("DEBUG") else logging.INFO,
+        "{}/{}.log".format(app.config.get("LOG_DIR"), application_name) if app.config.get("LOG_DIR") else None
+    )
     #
     # logger_flask_app = logging.getLogger("flask_app")
     # app.logger.addHandler(logger_flask_app)
-    
-    # No-cache configured here after each request
+
+    # Request latency, labeled by route, recorded for the /metrics endpoint
+    @app.before_request
+    def start_timer():
+        g.request_started = time.perf_counter()
+
+    @app.after_request
+    def record_request(response):
+        started = g.get("request_started")
+        if started is not None:
+            route = request.url_rule.rule if request.url_rule else "unmatched"
+            metrics.http_request_duration.observe(time.perf_counter() - started,
+                                                  request.method, route, response.status_code)
+        return response
+
+    # Wall time breakdown (DB, serialization, rest) sent in the Server-Timing header
+    if app.config.get("SERVER_TIMING"):
+        @app.after_request
+        def server_timing(response):
+            started = g.get("request_started")
+            if started is not None:
+                total = (time.perf_counter() - started) * 1000
+                db_time = g.get("db_time", 0.0) * 1000
+                serialization_time = g.get("serialization_time", 0.0) * 1000
+                other = max(total - db_time - serialization_time, 0.0)
+                response.headers["Server-Timing"] = (
+                    "db;dur={:.2f}, serialize;dur={:.2f}, app;dur={:.2f}, total;dur={:.2f}".format(
+                        db_time, serialization_time, other, total)
+                )
+            return response
+
+    # Cache policy (CACHE_POLICIES in the config) applied after each request,
+    # with a strong ETag so clients can revalidate and get a 304
     @app.after_request
-    def no_cache(response):
-        response.headers["Cache-Control"] = "no-cache, no-store, must-revalidate, public, max-age=0"
-        response.headers["Expires"] = 0
-        response.headers["Pragma"] = "no-cache"
+    def cache_policy(response):
+        if 200 <= response.status_code < 300 or response.status_code == 304:
+            policy = get_cache_policy(app.config, request.endpoint, request.blueprint)
+        else:
+            # An error must not be served from a cache once the cause is fixed
+            policy = app.config.get("ERROR_CACHE_POLICY", "no-store")
+        response.headers["Cache-Control"] = policy
+        if "no-store" in policy:
+            response.headers["Expires"] = 0
+            response.headers["Pragma"] = "no-cache"
+        elif (request.method in ("GET", "HEAD") and response.status_code == 200
+              and not response.direct_passthrough and not response.is_streamed):
+            # Files sent by send_static_file (direct passthrough) already carry their own ETag
+            response.add_etag()
+            response.make_conditional(request)
         return response
     
-    # Custom exception handler ApiErrorException
+    # Custom exception handler ApiErrorException, encoded like any jsonify
+    # response: JSON, NDJSON or MessagePack depending on the Accept header
     @app.errorhandler(ApiErrorException)
     def handle_exception(error):
         output = jsonify(error.to_dict())
@@ -63,30 +108,105 @@ def create_app(application_name, env):
         output.status_code = error.status_code
         return output
 
+    # Documentation tree loaded in memory once, see modules.lib.static_cache
+    app.extensions["doc_assets"] = StaticAssetCache(
+        join(app.static_folder, "doc", "html"), app.config.get("DOC_ASSETS_CHECK_INTERVAL", 2.0)
+    )
+
     import sys
     app.logger.info(sys.version_info)
-    
-    auto_register_blueprint_from_directory(app, "modules/controlled_routes")
+
+    timings = {"config": time.perf_counter() - started}
+    timings.update(auto_register_blueprint_from_directory(app, "modules/controlled_routes"))
+    timings["total"] = time.perf_counter() - started
+    app.extensions["startup_timings"] = timings
+    app.logger.info("Startup timings (ms): %s",
+                    ", ".join("{}={:.1f}".format(k, v * 1000) for k, v in timings.items()))
     return app
 
 
+def get_cache_policy(config, endpoint, blueprint):
+    """Return the Cache-Control value of a request: the policy of its endpoint
+    ("blueprint.function"), else the one of its blueprint, else the default one.
+    """
+    policies = config.get("CACHE_POLICIES", {})
+    if endpoint in policies:
+        return policies[endpoint]
+    if blueprint in policies:
+        return policies[blueprint]
+    return config.get("DEFAULT_CACHE_POLICY", "private, no-cache")
+
+
 def auto_register_blueprint_from_directory(app, path):
-    previous_directory = getcwd()
-    chdir(app.config["BASE_DIR"])
-    files = [
-        splitext(f)[0]
-        for f in listdir(path)
-        if isfile(join(path, f)) and f.lower().endswith(".py")
-    ]
-    path = path.replace("/", ".")
-    path = path.replace("\\", ".")
-    for file in files:
-        module = importlib.import_module(path + "." + file)
-        for item in dir(module):
-            blueprint = getattr(module, item)
-            if isinstance(blueprint, Blueprint):
-                app.register_blueprint(blueprint)
-    chdir(previous_directory)
+    """Import the modules of a directory (relative to BASE_DIR) and register
+    the blueprints they define.
+
+    When BLUEPRINT_MANIFEST is set in the config, the modules and blueprint
+    names found are saved in this file. Later boots then import the same
+    modules (those without blueprints too, as they may register routes
+    another way) but skip looking for blueprints in them, as long as the
+    files of the directory are unchanged.
+
+    :return: Time spent importing modules and registering blueprints
+    :rtype: dict
+    """
+    directory = join(app.config["BASE_DIR"], path)
+    package = path.replace("/", ".").replace("\\", ".")
+    files = {
+        f: stat(join(directory, f)).st_mtime
+        for f in listdir(directory)
+        if isfile(join(directory, f)) and f.lower().endswith(".py")
+    }
+    timings = {"import": 0.0, "registration": 0.0}
+
+    manifest_path = app.config.get("BLUEPRINT_MANIFEST")
+    manifest = _load_blueprint_manifest(manifest_path, files) if manifest_path else None
+    if manifest is None:
+        blueprints = {}
+        for file in sorted(files):
+            started = time.perf_counter()
+            module = importlib.import_module(package + "." + splitext(file)[0])
+            timings["import"] += time.perf_counter() - started
+            blueprints[module.__name__] = [item for item in dir(module)
+                                           if isinstance(getattr(module, item), Blueprint)]
+        if manifest_path:
+            _save_blueprint_manifest(manifest_path, files, blueprints)
+    else:
+        blueprints = manifest
+
+    for module_name, names in blueprints.items():
+        started = time.perf_counter()
+        module = importlib.import_module(module_name)
+        timings["import"] += time.perf_counter() - started
+        started = time.perf_counter()
+        for name in names:
+            app.register_blueprint(getattr(module, name))
+        timings["registration"] += time.perf_counter() - started
+    return timings
+
+
+def _load_blueprint_manifest(manifest_path, files):
+    """Return the modules and blueprints of a manifest, or None if it is
+    missing, written by another version or the files it was built from changed."""
+    try:
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if manifest.get("version") != _BLUEPRINT_MANIFEST_VERSION or manifest.get("files") != files:
+        return None
+    return manifest.get("blueprints")
+
+
+def _save_blueprint_manifest(manifest_path, files, blueprints):
+    try:
+        # Written aside then renamed, so a worker never reads a partial file
+        temporary_path = "{}.{}.tmp".format(manifest_path, getpid())
+        with open(temporary_path, "w") as f:
+            json.dump({"version": _BLUEPRINT_MANIFEST_VERSION, "files": files, "blueprints": blueprints}, f)
+        replace(temporary_path, manifest_path)
+    except OSError as e:
+        logging.getLogger(__name__).warning("Blueprint manifest not saved: %s", e)
 
 
 if __name__ == "__main__":  # code to execute if called from command-line
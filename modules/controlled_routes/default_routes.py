@@ -4,6 +4,7 @@
 from flask import Blueprint, jsonify
 
 import modules.kernel.default_functions as default_func
+from modules.lib.asgi import async_route
 
 blueprint_default = Blueprint("blueprint_default", __name__)
 
@@ -18,3 +19,15 @@ def r_hello():
     """
     output = default_func.k_hello()
     return jsonify(output)
+
+
+@async_route("/hello_async", methods=["GET"])
+async def r_hello_async(request):
+    """This is an example of async route that you could remove.
+    It is only served behind the ASGI entry point (asgi.py), where handlers
+    can await modules.lib.aiodb queries without holding a thread.
+
+    :return: Hello world!
+    :rtype: :class:`str`
+    """
+    return default_func.k_hello()
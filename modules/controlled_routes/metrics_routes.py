@@ -0,0 +1,32 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from flask import Blueprint, Response
+
+from modules.lib.metrics import registry
+
+blueprint_metrics = Blueprint("blueprint_metrics", __name__)
+
+
+@blueprint_metrics.route("/metrics", methods=["GET"])
+def r_metrics():
+    """
+    Expose the service metrics (query and request latencies, rows, errors).
+    Under the pre-fork server, the values are summed over every worker.
+
+    .. :quickref: Prometheus metrics
+
+    **Request exemple**:
+
+        .. sourcecode:: http
+
+            GET /metrics
+
+    :Status:
+
+        - 200: Success
+
+    :Return Type: Prometheus text format
+
+    """
+    return Response(registry.render(), mimetype="text/plain; version=0.0.4")
@@ -0,0 +1,26 @@
+from modules.lib.formatted_output import Output, Status
+
+
+class ApiErrorException(Exception):
+    """
+    Error raised by routes and kernel functions to answer with an Output envelope
+    and a real HTTP status code (see the handler registered in create_app).
+    """
+    status_code = 400
+
+    def __init__(self, message, status_code=None, payload=None, code=""):
+        """
+        :param message: <str> Message of the envelope
+        :param status_code: <int> HTTP status code of the response, 400 when not set
+        :param payload: <dict> Data of the envelope
+        :param code: <str> Application error code
+        """
+        super(ApiErrorException, self).__init__(message)
+        self.message = message
+        if status_code is not None:
+            self.status_code = status_code
+        self.payload = payload
+        self.code = code
+
+    def to_dict(self):
+        return Output(status=Status.ERROR, message=self.message, code=self.code, data=self.payload).as_dict()
@@ -16,24 +16,128 @@ class Config(object):
     # If you want to enable UTF-8 in json, uncomment :
     # JSON_AS_ASCII = False
 
+    # Each DATABASE entry may hold a "POOL" dict to share a pool of
+    # connections across requests instead of connecting on every request:
+    # "POOL": {
+    #     "MIN_SIZE": 1,            # connections kept open even when idle
+    #     "MAX_SIZE": 10,           # upper bound, keep it under max_connections
+    #     "IDLE_TIMEOUT": 300,      # seconds before an extra idle connection is closed
+    #     "CHECKOUT_TIMEOUT": 30,   # seconds to wait when the pool is exhausted
+    #     "HEALTH_CHECK": True,     # ping connections before handing them out
+    #     "HEALTH_CHECK_AFTER": 5,  # ...only if idle for more than these seconds
+    # }
+    # and a "PREPARED_STATEMENTS" dict to have execute_query PREPARE each
+    # statement once per connection and run it with EXECUTE afterwards:
+    # "PREPARED_STATEMENTS": {
+    #     "MAX_SIZE": 100,          # statements kept prepared per connection (LRU)
+    # }
+    # Read queries can be spread over streaming replicas with a "REPLICAS"
+    # list; each replica only lists what differs from the primary:
+    # "REPLICAS": [
+    #     {"HOST": "replica-1", "WEIGHT": 2},
+    #     {"HOST": "replica-2"},    # WEIGHT defaults to 1
+    # ],
+    # "MAX_REPLICA_LAG": 10,        # seconds behind the primary before a replica is skipped
+    # "REPLICA_CHECK_INTERVAL": 5,  # seconds between two lag measurements of a replica
+    # Writes, reads a replica refuses (nextval, FOR UPDATE...) and every read
+    # following a write in the same request go to the primary; pass
+    # use_primary=True to execute_query for other fresh reads and for
+    # functions writing to the database.
+    # An "ADMISSION" dict bounds the queries running at once on the database;
+    # when it is saturated, requests fail fast with a 503 instead of piling up:
+    # "ADMISSION": {
+    #     "MAX_CONCURRENT": 8,      # queries running at once, keep it <= POOL MAX_SIZE
+    #     "MAX_QUEUE": 32,          # queries allowed to wait for a slot, others get a 503
+    #     "QUEUE_TIMEOUT": 2,       # seconds a query may wait before getting a 503
+    # }
+    # "CONNECT_TIMEOUT" (seconds) and "STATEMENT_TIMEOUT" (milliseconds)
+    # override DB_CONNECT_TIMEOUT and DB_STATEMENT_TIMEOUT for one database.
+    # "ID_BLOCK_SIZE" (100 by default) is the number of ids next_id reserves
+    # per query, and a "WRITE_BEHIND" dict tunes the buffers of queue_insert:
+    # "WRITE_BEHIND": {
+    #     "MAX_BATCH": 500,         # rows per multi-row insert
+    #     "FLUSH_INTERVAL": 1.0,    # seconds a row may wait before being written
+    #     "MAX_QUEUE": 10000,       # rows waiting per table before callers are slowed down
+    #     "PUT_TIMEOUT": 0.5,       # seconds a caller may be slowed down before getting a 503
+    # }
     DB_CONNECTOR_TPL = """host=%(HOST)s dbname=%(NAME)s
                     user=%(USER)s password=%(PASSWORD)s"""
     DATABASE = {}
+    # Seconds to wait for the server when connecting, and milliseconds after
+    # which the server cancels a statement (None: no limit). execute_query
+    # also takes a statement_timeout for a single call
+    DB_CONNECT_TIMEOUT = 10
+    DB_STATEMENT_TIMEOUT = None
+    # Memory budget of the in-process query result cache (see cache_ttl
+    # in execute_query_and_return_output). Each PREFORK worker has its own
+    # cache, and budget: a result may be cached once per worker, and a write
+    # only invalidates the cache of the worker that made it (cache_ttl bounds
+    # how stale the others can be)
+    QUERY_CACHE_MAX_BYTES = 64 * 1024 * 1024
+    # Queries and results logged at DEBUG level: share of the queries logged
+    # and size above which logged values are cut
+    QUERY_LOG_SAMPLE_RATE = 1.0
+    QUERY_LOG_MAX_CHARS = 2000
+    # Add a Server-Timing header (db, serialize, app, total) to every response
+    SERVER_TIMING = False
     BASE_DIR = "/opt/unit/"
     LOG_DIR = "/var/log/unit/services/"
 
+    # File caching the modules and blueprints found in controlled_routes,
+    # so later boots skip the scan (None disables it)
+    BLUEPRINT_MANIFEST = None
+
+    # Launcher used when service.py is run directly (see
+    # modules.lib.prefork.PreforkServer); None starts Flask's development server.
+    # Workers are separate processes: /metrics sums the values every worker
+    # writes into METRICS_DIR, while caches (query results...) are per worker
+    PREFORK = {
+        "WORKERS": 4,               # worker processes
+        "THREADS": 8,               # threads per worker
+        "MAX_REQUESTS": 10000,      # requests before a worker is recycled (0: never)
+        "MAX_REQUESTS_JITTER": 1000,
+        "REUSE_PORT": False,        # one SO_REUSEPORT socket per worker
+        "GRACEFUL_TIMEOUT": 30,     # seconds given to workers to finish on stop/reload
+        "METRICS_DIR": None,        # directory shared by the workers (None: a temporary one)
+        "METRICS_INTERVAL": 5,      # seconds between two writes of the metrics of a worker
+    }
+
+    # Seconds between two checks of the documentation files' mtime
+    # (0 disables reloading)
+    DOC_ASSETS_CHECK_INTERVAL = 2.0
+
+    # Cache-Control sent with the successful (2xx and 304) responses, per endpoint
+    # ("blueprint.function") or per blueprint; the endpoint wins. Unless the policy
+    # has "no-store", responses get an ETag and conditional requests are answered
+    # with a 304. Every other response gets ERROR_CACHE_POLICY.
+    DEFAULT_CACHE_POLICY = "private, no-cache"
+    ERROR_CACHE_POLICY = "no-store"
+    CACHE_POLICIES = {
+        "blueprint_basic.r_doc": "public, max-age=3600",
+        "blueprint_basic.r_doc_ressources": "public, max-age=86400",
+        "blueprint_metrics": "no-cache, no-store, must-revalidate, max-age=0",
+    }
+
 
 class ProdConfig(Config):
     """Production configuration."""
 
     ENV = "production"
     DEBUG = False
+    QUERY_LOG_SAMPLE_RATE = 0.01
+    QUERY_LOG_MAX_CHARS = 500
+    DB_CONNECT_TIMEOUT = 5
+    DB_STATEMENT_TIMEOUT = 30000
 
 
 class DevConfig(Config):
     """Development configuration."""
 
     ENV = "development"
+    SERVER_TIMING = True
+    DB_STATEMENT_TIMEOUT = 60000
+    # Flask's development server, for its debugger and reloader
+    PREFORK = None
 
     # DEBUG mode : an interactive debugger will be shown for unhandled
     # exceptions, and the server will be reloaded when code changes.
@@ -47,6 +151,8 @@ class DevConfig(Config):
         "PASSWORD": "test1234",
         "NAME": "postgres",
         "PORT": 5432,
+        "POOL": {"MIN_SIZE": 1, "MAX_SIZE": 10},
+        "ADMISSION": {"MAX_CONCURRENT": 10, "MAX_QUEUE": 40, "QUEUE_TIMEOUT": 5},
     }
 
 
@@ -54,6 +160,8 @@ class StagingConfig(Config):
     """Staging configuration."""
 
     ENV = "staging"
+    SERVER_TIMING = True
+    DB_STATEMENT_TIMEOUT = 30000
     DEBUG = True
 
     # TESTING mode : Enable the test mode of Flask extensions (later).
@@ -66,6 +174,8 @@ class StagingConfig(Config):
         "PASSWORD": "test1234",
         "NAME": "postgres",
         "PORT": 5432,
+        "POOL": {"MIN_SIZE": 1, "MAX_SIZE": 10},
+        "ADMISSION": {"MAX_CONCURRENT": 10, "MAX_QUEUE": 40, "QUEUE_TIMEOUT": 5},
     }
 
     # If you need to set another database
@@ -84,6 +194,8 @@ class StagingConfig(Config):
 class LocalConfig(Config):
     """Used to run flask locally"""
     ENV = "local"
+    SERVER_TIMING = True
+    PREFORK = None
     DEBUG = True
     BASE_DIR = os.path.dirname(os.getcwd())
     LOG_DIR = None
@@ -1,10 +1,9 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
-import os
 import socket
 
-from flask import current_app
+from flask import abort, current_app
 
 
 def k_locate():
@@ -47,15 +46,14 @@ def k_locate():
 def k_has_doc():
     """
     
+    Answered from the documentation manifest built at startup.
+    
     :return: Static file
     :rtype: :class: dict
     
     """
-    path = "/opt/unit"
     service = current_app.config["APP_NAME"]
-    has_documentation_generated = os.path.exists(
-        os.path.join(path, service, "modules", "static", "doc", "html")
-    )
+    has_documentation_generated = current_app.extensions["doc_assets"].has_files
     current_app.logger.info(has_documentation_generated)
     if has_documentation_generated:
         output = {}
@@ -87,14 +85,14 @@ def k_doc():
     """
     
     :return: Static file
-    :rtype: :class: ?
+    :rtype: :class: `flask.Response`
     
     """
 
-    try:
-        return current_app.send_static_file("doc/html/index.html")
-    except Exception as e:
-        current_app.logger.exception(e)
+    response = current_app.extensions["doc_assets"].send("index.html")
+    if response is None:
+        abort(404)
+    return response
 
 
 def k_doc_ressources(name, folder2, folder1):
@@ -110,24 +108,21 @@ def k_doc_ressources(name, folder2, folder1):
     :type folder1: :class: `str`
     
     :return: Static file
-    :rtype: :class: ?
+    :rtype: :class: `flask.Response`
     
     """
 
-    try:
-        if name == "index.html":
-            return current_app.send_static_file("doc/html/" + name)
-        else:
-            if folder2 is None:
-                return current_app.send_static_file("doc/html/_static/" + name)
-            elif folder1 is None:
-                return current_app.send_static_file(
-                    "doc/html/_static/" + folder2 + "/" + name
-                )
-            else:
-                return current_app.send_static_file(
-                    "doc/html/_static/" + folder1 + "/" + folder2 + "/" + name
-                )
-    except Exception as e:
-        current_app.logger.exception(e)
-    return None
+    if name == "index.html":
+        path = name
+    elif folder2 is None:
+        path = "_static/" + name
+    elif folder1 is None:
+        path = "_static/" + folder2 + "/" + name
+    else:
+        path = "_static/" + folder1 + "/" + folder2 + "/" + name
+
+    # Only files listed in the manifest can be served
+    response = current_app.extensions["doc_assets"].send(path)
+    if response is None:
+        abort(404)
+    return response
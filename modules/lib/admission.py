@@ -0,0 +1,73 @@
+import threading
+import time
+
+
+class AdmissionRejected(Exception):
+    """Raised when a query could not be admitted: the wait queue is full or the wait timed out."""
+
+
+class AdmissionLimiter:
+    """
+    Bounds the number of queries running at once on a database.
+
+    Up to ``max_concurrent`` callers run; up to ``max_queue`` more wait for a
+    slot, at most ``queue_timeout`` seconds. Anyone else is rejected at once,
+    so a slow database makes requests fail fast instead of piling up threads.
+    """
+
+    def __init__(self, max_concurrent, max_queue=0, queue_timeout=1.0):
+        if max_concurrent < 1 or max_queue < 0:
+            raise ValueError("Invalid admission limits (concurrent: {}, queue: {})".format(max_concurrent,
+                                                                                        max_queue))
+        self.max_concurrent = max_concurrent
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+
+        self._cond = threading.Condition()
+        self._active = 0
+        self._waiting = 0
+        self.rejected = 0
+
+    def acquire(self):
+        """
+        Take a slot, waiting in the queue if needed.
+        :raise AdmissionRejected: The queue is full or no slot was freed in time
+        """
+        with self._cond:
+            # Newcomers do not overtake callers already waiting
+            if self._active < self.max_concurrent and not self._waiting:
+                self._active += 1
+                return
+            if self._waiting >= self.max_queue:
+                self.rejected += 1
+                raise AdmissionRejected("Too many queries waiting ({} running, {} queued)".format(
+                    self._active, self._waiting))
+            self._waiting += 1
+            try:
+                deadline = time.monotonic() + self.queue_timeout
+                while self._active >= self.max_concurrent:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self.rejected += 1
+                        raise AdmissionRejected("No query slot freed after {}s".format(self.queue_timeout))
+                    self._cond.wait(remaining)
+                self._active += 1
+            finally:
+                self._waiting -= 1
+
+    def release(self):
+        with self._cond:
+            self._active -= 1
+            self._cond.notify()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
+
+    @property
+    def stats(self):
+        with self._cond:
+            return {"active": self._active, "waiting": self._waiting, "rejected": self.rejected}
@@ -0,0 +1,198 @@
+import asyncio
+import logging
+
+import psycopg2
+import psycopg2.extensions
+import psycopg2.extras
+
+from modules.lib.formatted_output import Output, Status
+from modules.lib.logs import log_query
+from modules.lib.pool import connection_dsn
+
+logger = logging.getLogger(__name__)
+
+# Filled by init_app: async code runs outside of any Flask app context
+_databases = {}
+_timeouts = {}
+_pools = {}
+
+
+def init_app(app):
+    """Give the async database functions access to the DATABASE config. This is
+    called by the application factory.
+    """
+    _databases.clear()
+    _databases.update(app.config["DATABASE"])
+    _timeouts["connect_timeout"] = app.config.get("DB_CONNECT_TIMEOUT")
+    _timeouts["statement_timeout"] = app.config.get("DB_STATEMENT_TIMEOUT")
+
+
+async def _wait(connection):
+    """Drive an async psycopg2 connection until the pending operation is done,
+    without blocking the event loop."""
+    loop = asyncio.get_event_loop()
+    while True:
+        state = connection.poll()
+        if state == psycopg2.extensions.POLL_OK:
+            return
+        future = loop.create_future()
+
+        def ready():
+            if not future.done():
+                future.set_result(None)
+
+        fd = connection.fileno()
+        if state == psycopg2.extensions.POLL_READ:
+            loop.add_reader(fd, ready)
+            try:
+                await future
+            finally:
+                loop.remove_reader(fd)
+        elif state == psycopg2.extensions.POLL_WRITE:
+            loop.add_writer(fd, ready)
+            try:
+                await future
+            finally:
+                loop.remove_writer(fd)
+        else:
+            raise psycopg2.OperationalError("Bad poll state: {}".format(state))
+
+
+class AsyncConnectionPool:
+    """
+    Pool of asynchronous psycopg2 connections, bound to the event loop using it.
+    Async connections are always in autocommit mode.
+    """
+
+    def __init__(self, dsn, min_size=1, max_size=10, checkout_timeout=30):
+        self.dsn = dsn
+        self.min_size = min_size
+        self.max_size = max_size
+        self.checkout_timeout = checkout_timeout
+        self._idle = []
+        self._size = 0
+        self._cond = asyncio.Condition()
+
+    async def _connect(self):
+        connection = psycopg2.connect(self.dsn, async_=True)
+        try:
+            await _wait(connection)
+        except Exception:
+            connection.close()
+            raise
+        return connection
+
+    async def getconn(self):
+        async with self._cond:
+            while not self._idle and self._size >= self.max_size:
+                await asyncio.wait_for(self._cond.wait(), self.checkout_timeout)
+            while self._idle:
+                connection = self._idle.pop()
+                if not connection.closed:
+                    return connection
+                self._size -= 1
+            self._size += 1
+        try:
+            return await self._connect()
+        except Exception:
+            async with self._cond:
+                self._size -= 1
+                self._cond.notify()
+            raise
+
+    async def putconn(self, connection, close=False):
+        async with self._cond:
+            if close or connection.closed:
+                self._size -= 1
+                if not connection.closed:
+                    connection.close()
+            else:
+                self._idle.append(connection)
+            self._cond.notify()
+
+    async def closeall(self):
+        async with self._cond:
+            for connection in self._idle:
+                connection.close()
+            self._size -= len(self._idle)
+            self._idle = []
+
+
+def get_pool(db_key):
+    """Return the async pool of a database, creating it on first use. Sizes are
+    taken from the "POOL" entry of the database config, as for the sync pool.
+    """
+    if db_key not in _databases:
+        raise KeyError("The database '{}' is not defined in the current config.".format(db_key))
+    pool = _pools.get(db_key)
+    if pool is None:
+        db_config = _databases[db_key]
+        pool_config = db_config.get("POOL") or {}
+        pool = AsyncConnectionPool(
+            connection_dsn(db_config, **_timeouts),
+            min_size=pool_config.get("MIN_SIZE", 1),
+            max_size=pool_config.get("MAX_SIZE", 10),
+            checkout_timeout=pool_config.get("CHECKOUT_TIMEOUT", 30),
+        )
+        _pools[db_key] = pool
+    return pool
+
+
+async def execute_query(db_key, query, query_params=None, fetch=None, fetch_all=None, check_result=False):
+    """
+    Asynchronous counterpart of modules.lib.db.execute_query. The event loop keeps serving
+    other requests while the query runs. Async connections are in autocommit mode, so writes
+    are committed right away.
+    :param db_key: <str> Key to identify db in the config
+    :param query: <str> The query string, already properly formatted
+    :param query_params: <dict> the query parameters to be used
+    :param fetch: <bool> If set to true, returns the result of the query
+    :param fetch_all: <bool> If set to true, returns the list of results of the query
+    :param check_result: <bool> If set to true, checks if any result was returned by the query
+    """
+    result = None
+    pool = get_pool(db_key)
+    connection = await pool.getconn()
+    cursor = None
+    # Until the query completed, the connection may still have a result in flight (cancellation...)
+    broken = True
+    try:
+        cursor = connection.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
+        log_query(logger, "Executing the following query: \n%s\nusing these params: %s", query, query_params)
+        cursor.execute(query, query_params)
+        await _wait(connection)
+        if fetch:
+            result = cursor.fetchone()
+        elif fetch_all:
+            result = cursor.fetchall()
+        broken = False
+        if check_result:
+            assert result
+    except (psycopg2.OperationalError, psycopg2.InterfaceError, psycopg2.ProgrammingError, AssertionError) as pge:
+        logger.error(pge, exc_info=True)
+        broken = broken and isinstance(pge, (psycopg2.OperationalError, psycopg2.InterfaceError))
+        raise
+    finally:
+        if cursor:
+            cursor.close()
+        await pool.putconn(connection, close=broken)
+    return result
+
+
+async def execute_query_and_return_output(db_key, query, query_data, fetch=None, fetch_all=None,
+                                          no_result_message="No data found."):
+    """Asynchronous counterpart of modules.lib.db.execute_query_and_return_output."""
+    try:
+        result = await execute_query(db_key, query, query_data, fetch=fetch, fetch_all=fetch_all)
+        log_query(logger, "Query result: %s", result)
+        if result:
+            if fetch_all:
+                data = [dict(r) for r in result]
+            else:
+                data = dict(result)
+            return Output(status=Status.SUCCESS, data=data).as_dict()
+
+        return Output(status=Status.WARNING, message=no_result_message).as_dict()
+
+    except (psycopg2.OperationalError, psycopg2.ProgrammingError) as pge:
+        return Output(status=Status.ERROR, message=pge).as_dict()
@@ -0,0 +1,84 @@
+import json
+
+from urllib.parse import parse_qs
+
+# Async handlers registered with async_route: path -> (methods, handler)
+_async_routes = {}
+
+
+def async_route(path, methods=("GET",)):
+    """
+    Register a coroutine as the handler of a path when the service runs behind the ASGI
+    entry point (asgi.py). The handler receives an AsyncRequest and returns a JSON-serializable
+    value, or a (value, status code) tuple, sent back as JSON.
+    Under the WSGI entry point (service.py) these routes are not served.
+    """
+    def decorator(handler):
+        _async_routes[path] = (tuple(m.upper() for m in methods), handler)
+        return handler
+    return decorator
+
+
+class AsyncRequest:
+    """Minimal request object given to async handlers."""
+
+    def __init__(self, scope, body):
+        self.scope = scope
+        self.method = scope["method"]
+        self.path = scope["path"]
+        self.args = {k: v[-1] for k, v in parse_qs(scope.get("query_string", b"").decode("latin-1")).items()}
+        self.headers = {k.decode("latin-1").lower(): v.decode("latin-1") for k, v in scope.get("headers", [])}
+        self.body = body
+
+    def get_json(self):
+        return json.loads(self.body) if self.body else None
+
+
+class AsgiApplication:
+    """
+    ASGI application serving the async routes on the event loop, so a single worker can wait
+    on many queries at once, and every other request through the Flask app (via asgiref).
+    """
+
+    def __init__(self, flask_app):
+        # asgiref is only needed when running behind an ASGI server
+        from asgiref.wsgi import WsgiToAsgi
+
+        self.flask_app = flask_app
+        self.wsgi = WsgiToAsgi(flask_app)
+
+    async def __call__(self, scope, receive, send):
+        route = _async_routes.get(scope.get("path")) if scope["type"] == "http" else None
+        if route is None:
+            await self.wsgi(scope, receive, send)
+            return
+
+        methods, handler = route
+        if scope["method"] not in methods:
+            await self._send_json(send, {"status": {"name": "error", "message": "Method not allowed"}}, 405)
+            return
+
+        body = b""
+        more_body = True
+        while more_body:
+            message = await receive()
+            body += message.get("body", b"")
+            more_body = message.get("more_body", False)
+
+        result = await handler(AsyncRequest(scope, body))
+        status_code = 200
+        if isinstance(result, tuple):
+            result, status_code = result
+        await self._send_json(send, result, status_code)
+
+    async def _send_json(self, send, payload, status_code):
+        body = self.flask_app.json.dumps(payload).encode("utf-8")
+        await send({
+            "type": "http.response.start",
+            "status": status_code,
+            "headers": [
+                (b"content-type", b"application/json"),
+                (b"content-length", str(len(body)).encode("latin-1")),
+            ],
+        })
+        await send({"type": "http.response.body", "body": body})
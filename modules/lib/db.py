@@ -1,19 +1,113 @@
+import atexit
+import base64
+import binascii
+import io
+import itertools
 import psycopg2
+import psycopg2.extras
 import json
-import traceback
+import queue
+import re
+import threading
+import time
+import uuid
 
-from flask import current_app, g
+from flask import Response, current_app, g, has_app_context, jsonify, stream_with_context
 
+from modules.exceptions.api_error_exception import ApiErrorException
+from modules.lib import metrics
+from modules.lib.admission import AdmissionLimiter, AdmissionRejected
 from modules.lib.formatted_output import Output, Status
+from modules.lib.id_allocator import IdBlockAllocator
+from modules.lib.logs import configure_query_logging, log_query
+from modules.lib.metrics import query_fingerprint
+from modules.lib.negotiation import JSON, NDJSON, negotiated_mimetype
+from modules.lib.pool import ConnectionPool, PoolTimeout, connection_dsn
+from modules.lib.prepared_statements import StatementConnection, execute_prepared
+from modules.lib.query_cache import query_cache, read_tables, written_tables
+from modules.lib.replicas import REPLICA_LAG_QUERY, ReplicaSet, requires_primary
+from modules.lib.write_behind import WriteBehindBuffer
 
+# Process-wide connection pools, one per database key (or (key, replica index))
+# having a "POOL" entry
+_pools = {}
+_pools_lock = threading.Lock()
+_replica_sets = {}
+_limiters = {}
+# One id allocator per (database key, sequence name), see next_id
+_id_allocators = {}
+# One write-behind buffer per (database key, table name), see queue_insert
+_write_behind = {}
 
-def get_db(database):
+_IDENTIFIER = re.compile(r"^[A-Za-z_][A-Za-z0-9_]*$")
+
+
+def _connection_dsn(db_config):
+    return connection_dsn(db_config, current_app.config.get("DB_CONNECT_TIMEOUT"),
+                          current_app.config.get("DB_STATEMENT_TIMEOUT"))
+
+
+def _db_config(database, replica=None):
+    """Config of a database, or of one of its replicas: replica entries only
+    hold what differs from the primary (usually HOST, and WEIGHT)."""
+    db_config = current_app.config["DATABASE"][database]
+    if replica is None:
+        return db_config
+    replica_config = dict(db_config)
+    replica_config.pop("REPLICAS")
+    replica_config.update(db_config["REPLICAS"][replica])
+    return replica_config
+
+
+def get_pool(database, replica=None):
+    """Return the process-wide connection pool of a database, creating it on
+    first use. Pooling is enabled by adding a "POOL" dict to the database
+    entry in Flask's config, e.g.
+    ``{"MIN_SIZE": 1, "MAX_SIZE": 10, "IDLE_TIMEOUT": 300, "CHECKOUT_TIMEOUT": 30,
+    "HEALTH_CHECK": True, "HEALTH_CHECK_AFTER": 5}``.
+
+    :param database: Database key set in Flask's config.
+    :type database: str
+    :param replica: Index of the replica in the "REPLICAS" list, None for the primary.
+    :type replica: int
+    :return: The pool, or None if pooling is not configured for this database
+    :rtype: :class:`modules.lib.pool.ConnectionPool`
+    """
+    db_config = _db_config(database, replica)
+    pool_config = db_config.get("POOL")
+    if not pool_config:
+        return None
+
+    key = database if replica is None else (database, replica)
+    pool = _pools.get(key)
+    if pool is None:
+        with _pools_lock:
+            pool = _pools.get(key)
+            if pool is None:
+                pool = ConnectionPool(
+                    _connection_dsn(db_config),
+                    min_size=pool_config.get("MIN_SIZE", 1),
+                    max_size=pool_config.get("MAX_SIZE", 10),
+                    idle_timeout=pool_config.get("IDLE_TIMEOUT", 300),
+                    checkout_timeout=pool_config.get("CHECKOUT_TIMEOUT", 30),
+                    health_check=pool_config.get("HEALTH_CHECK", True),
+                    health_check_after=pool_config.get("HEALTH_CHECK_AFTER", 5),
+                    connection_factory=StatementConnection,
+                )
+                _pools[key] = pool
+    return pool
+
+
+def get_db(database, replica=None):
     """Connect to the application's configured database. The connection
     is unique for each request and will be reused if this is called
-    again.
+    again. When the database has a pool configured, the connection is
+    checked out from it instead of being opened.
 
     :param database: Database key set in Flask's config.
     :type database: str
+    :param replica: Index of the replica in the "REPLICAS" list, None for the primary.
+    :type replica: int
     :return: Connection
     :rtype: :class:`psycopg2.connection`
     """
@@ -28,26 +122,147 @@ def get_db(database):
             )
         )
 
-    if database not in g.db:
-        g.db[database] = psycopg2.connect(
-            "host={HOST} user={USER} password={PASSWORD} dbname={NAME}".format(
-                **current_app.config["DATABASE"][database]
-            )
-        )
-    return g.db[database]
+    key = database if replica is None else (database, replica)
+    if key not in g.db:
+        pool = get_pool(database, replica)
+        if pool is not None:
+            try:
+                g.db[key] = pool.getconn()
+            except PoolTimeout as e:
+                current_app.logger.warning("Pool of %s exhausted: %s", database, e)
+                raise ApiErrorException("The database {} is overloaded, retry later.".format(database), 503)
+        else:
+            g.db[key] = psycopg2.connect(_connection_dsn(_db_config(database, replica)),
+                                         connection_factory=StatementConnection)
+    return g.db[key]
+
+
+def get_read_db(database, use_primary=False):
+    """Connection for a read-only query. When the database lists "REPLICAS",
+    one of them is picked by weighted round-robin among those whose
+    replication lag is under "MAX_REPLICA_LAG" seconds, and kept for the
+    rest of the request. Once the request wrote to the database, reads stay
+    on the primary so they see their own writes.
+
+    :param database: Database key set in Flask's config.
+    :type database: str
+    :param use_primary: Read from the primary anyway (read-your-writes across requests...)
+    :type use_primary: bool
+    :return: Connection
+    :rtype: :class:`psycopg2.connection`
+    """
+    db_config = current_app.config["DATABASE"].get(database, {})
+    if use_primary or not db_config.get("REPLICAS") or database in g.get("db_primary_only", ()):
+        return get_db(database)
+
+    if "db_replica" not in g:
+        g.db_replica = {}
+    if database not in g.db_replica:
+        g.db_replica[database] = _choose_replica(database)
+    replica = g.db_replica[database]
+    return get_db(database) if replica is None else get_db(database, replica)
+
+
+def _choose_replica(database):
+    db_config = current_app.config["DATABASE"][database]
+    replica_set = _replica_sets.get(database)
+    if replica_set is None:
+        with _pools_lock:
+            replica_set = _replica_sets.get(database)
+            if replica_set is None:
+                replica_set = ReplicaSet([r.get("WEIGHT", 1) for r in db_config["REPLICAS"]],
+                                         max_lag=db_config.get("MAX_REPLICA_LAG", 10),
+                                         check_interval=db_config.get("REPLICA_CHECK_INTERVAL", 5))
+                _replica_sets[database] = replica_set
+
+    checked = replica_set.due_for_check()
+    for replica in checked:
+        lag = None
+        try:
+            cursor = get_db(database, replica).cursor()
+            cursor.execute(REPLICA_LAG_QUERY)
+            lag = float(cursor.fetchone()[0])
+            cursor.close()
+        except (psycopg2.Error, ApiErrorException) as e:
+            # ApiErrorException: its pool is exhausted, as good as unreachable for this request
+            current_app.logger.warning("Replica %s of %s unusable: %s", replica, database, e)
+            _release_db((database, replica), close=isinstance(e, psycopg2.Error))
+        replica_set.set_lag(replica, lag)
+    chosen = replica_set.choose()
+    # Only the chosen replica keeps its connection until the end of the request
+    for replica in checked:
+        if replica != chosen:
+            _release_db((database, replica))
+    return chosen
+
+
+def _release_db(key, close=False):
+    """Give back (or close) the connection of the current request stored under key."""
+    connection = g.get("db", {}).pop(key, None)
+    if connection is None:
+        return
+    pool = _pools.get(key)
+    if pool is not None:
+        pool.putconn(connection, close=close)
+    elif not connection.closed:
+        connection.close()
+
+
+def get_limiter(database):
+    """Return the admission limiter of a database, set by an "ADMISSION" dict in its config entry,
+    e.g. ``{"MAX_CONCURRENT": 8, "MAX_QUEUE": 32, "QUEUE_TIMEOUT": 2}``.
+
+    :param database: Database key set in Flask's config.
+    :type database: str
+    :return: The limiter, or None if admission control is not configured for this database
+    :rtype: :class:`modules.lib.admission.AdmissionLimiter`
+    """
+    limiter = _limiters.get(database)
+    if limiter is None:
+        admission_config = current_app.config["DATABASE"][database].get("ADMISSION")
+        if not admission_config:
+            return None
+        with _pools_lock:
+            limiter = _limiters.get(database)
+            if limiter is None:
+                limiter = AdmissionLimiter(admission_config["MAX_CONCURRENT"],
+                                           max_queue=admission_config.get("MAX_QUEUE", 0),
+                                           queue_timeout=admission_config.get("QUEUE_TIMEOUT", 1.0))
+                _limiters[database] = limiter
+    return limiter
+
+
+def _admit(db_key):
+    """Take a query slot of the database; the caller releases the returned limiter (if any)."""
+    limiter = get_limiter(db_key)
+    if limiter is not None:
+        try:
+            limiter.acquire()
+        except AdmissionRejected as e:
+            metrics.db_admission_rejected.inc(db_key)
+            current_app.logger.warning("Query on %s rejected: %s", db_key, e)
+            raise ApiErrorException("The database {} is overloaded, retry later.".format(db_key), 503)
+    return limiter
 
 
 def close_db(e=None):
-    """If this request was connected to the database, close the
-    connection.
+    """If this request was connected to the database, give the connection
+    back to its pool, or close it when the database is not pooled.
     """
     db = g.get("db", None)
 
     if db is not None:
         for key in list(db):
-            if not db[key].closed:
-                db[key].close()
-            db.pop(key)
+            _release_db(key)
+
+
+def close_pools():
+    """Close every process-wide connection pool."""
+    with _pools_lock:
+        pools = list(_pools.values())
+        _pools.clear()
+    for pool in pools:
+        pool.closeall()
 
 
 def init_app(app):
@@ -55,21 +270,91 @@ def init_app(app):
     the application factory.
     """
     app.teardown_appcontext(close_db)
+    query_cache.max_bytes = app.config.get("QUERY_CACHE_MAX_BYTES", query_cache.max_bytes)
+    configure_query_logging(app.config.get("QUERY_LOG_SAMPLE_RATE", 1.0), app.config.get("QUERY_LOG_MAX_CHARS", 2000))
 
 
 def execute_query_and_return_output(db_key, query, query_data, commit=False, fetch=None, fetch_all=None,
-                                    no_result_message="No data found."):
+                                    no_result_message="No data found.", cache_ttl=None, cache_tables=None,
+                                    use_primary=False, page_key=None, page_cursor=None, page_size=50,
+                                    page_order="ASC", columnar=None, statement_timeout=None):
+    """
+    Executes the query and wraps its result in the Output envelope.
+    Read queries can be served from the in-process result cache by giving a cache_ttl; the entry is
+    dropped as soon as a committed write touches one of its tables.
+    Giving a page_key turns on keyset pagination: the query is wrapped to return the page_size rows
+    following the page_cursor token, and the token of the next page is returned in
+    optional["next_cursor"] (None on the last page). Every page costs the same as the first one
+    when the key is indexed.
+    :param cache_ttl: <int> Seconds the result may be served from the cache. No caching when not set
+    :param cache_tables: <list> Tables the result depends on; found in the FROM/JOIN clauses when not set
+    :param use_primary: <bool> Read from the primary even if the database has replicas
+    :param page_key: <str|list> Column(s) of the result ordering the pages; must be unique and not null
+    :param page_cursor: <str> Token returned with the previous page, None for the first page
+    :param page_size: <int> Number of rows per page
+    :param page_order: <str> "ASC" or "DESC"
+    :param columnar: <str> With fetch_all, "rows" returns {"columns": [...], "rows": [[...], ...]} and
+        "columns" returns {column: [values...]}, instead of one dict per row
+    :param statement_timeout: <int> Milliseconds after which the query is cancelled, see execute_query
+    """
+    if columnar not in (None, "rows", "columns"):
+        return Output(status=Status.ERROR, message="Invalid columnar mode {!r}.".format(columnar)).as_dict()
+    if page_key is not None:
+        if columnar:
+            return Output(status=Status.ERROR, message="Paginated results cannot be columnar.").as_dict()
+        try:
+            keys, query, query_data = _keyset_page_query(query, query_data, page_key, page_cursor, page_size,
+                                                         page_order)
+        except ValueError as e:
+            return Output(status=Status.ERROR, message=e).as_dict()
+        fetch_all = True
+
+    cache_key = None
+    if cache_ttl and not commit:
+        # Same precedence as execute_query: fetch wins over fetch_all
+        shape = "fetch" if fetch else "fetch_all" if fetch_all else None
+        if columnar and fetch_all:
+            shape = (shape, columnar)
+        cache_key = query_cache.make_key(db_key, query, query_data, shape)
+        if cache_key is not None:
+            hit, data = query_cache.get(cache_key)
+            if hit:
+                if page_key is not None:
+                    return _keyset_page_output(data, keys, page_size, no_result_message)
+                if data:
+                    return Output(status=Status.SUCCESS, data=data).as_dict()
+                return Output(status=Status.WARNING, message=no_result_message).as_dict()
+
     try:
-        result = execute_query(db_key, query, query_data, commit=commit, fetch=fetch, fetch_all=fetch_all)
-        current_app.logger.debug("Query result: {}".format(result))
-        if result:
+        result = execute_query(db_key, query, query_data, commit=commit, fetch=fetch, fetch_all=fetch_all,
+                               use_primary=use_primary, columnar=bool(columnar and fetch_all),
+                               statement_timeout=statement_timeout)
+        log_query(current_app.logger, "Query result: %s", result)
+        if columnar and fetch_all:
+            if not result["rows"]:
+                data = None
+            elif columnar == "columns":
+                data = dict(zip(result["columns"], (list(values) for values in zip(*result["rows"]))))
+            else:
+                data = result
+        elif result:
             if fetch_all:
                 data = [dict(r) for r in result]
             elif fetch:
                 data = dict(result)
             else:
                 data = result  # None
+        else:
+            data = None
+
+        if cache_key is not None:
+            tables = cache_tables if cache_tables is not None else read_tables(query)
+            query_cache.set(cache_key, data, cache_ttl, tables)
+
+        if page_key is not None:
+            return _keyset_page_output(data, keys, page_size, no_result_message)
 
+        if data:
             return Output(status=Status.SUCCESS, data=data).as_dict()
 
         return Output(status=Status.WARNING, message=no_result_message).as_dict()
@@ -78,7 +363,195 @@ def execute_query_and_return_output(db_key, query, query_data, commit=False, fet
         return Output(status=Status.ERROR, message=pge).as_dict()
 
 
-def execute_query(db_key, query, query_params=None, commit=False, fetch=None, fetch_all=None, check_result=False):
+def _keyset_page_query(query, query_data, page_key, page_cursor, page_size, page_order):
+    """Wraps the query to read one page after the cursor: WHERE (keys) > (last keys) ORDER BY keys LIMIT n + 1.
+    The extra row only tells whether there is a next page."""
+    keys = [page_key] if isinstance(page_key, str) else list(page_key)
+    if not keys or not all(_IDENTIFIER.match(key) for key in keys):
+        raise ValueError("Invalid page key {!r}.".format(page_key))
+    order = page_order.upper()
+    if order not in ("ASC", "DESC"):
+        raise ValueError("Invalid page order {!r}.".format(page_order))
+    if not isinstance(page_size, int) or page_size < 1:
+        raise ValueError("Invalid page size {!r}.".format(page_size))
+
+    positional = isinstance(query_data, (list, tuple))
+    params = list(query_data) if positional else dict(query_data or {})
+    where = ""
+    if page_cursor:
+        last = decode_page_cursor(page_cursor)
+        if len(last) != len(keys):
+            raise ValueError("Invalid cursor.")
+        if positional:
+            placeholders = ["%s"] * len(keys)
+            params.extend(last)
+        else:
+            placeholders = ["%(_page_{})s".format(i) for i in range(len(keys))]
+            params.update(("_page_{}".format(i), value) for i, value in enumerate(last))
+        where = " WHERE ({}) {} ({})".format(", ".join(keys), ">" if order == "ASC" else "<", ", ".join(placeholders))
+
+    if positional:
+        params.append(page_size + 1)
+        limit = "%s"
+    else:
+        params["_page_limit"] = page_size + 1
+        limit = "%(_page_limit)s"
+    paged_query = "SELECT * FROM ({}) AS page{} ORDER BY {} LIMIT {}".format(
+        query.strip().rstrip(";"), where, ", ".join("{} {}".format(key, order) for key in keys), limit)
+    return keys, paged_query, tuple(params) if positional else params
+
+
+def _keyset_page_output(data, keys, page_size, no_result_message):
+    rows = data or []
+    next_cursor = None
+    if len(rows) > page_size:
+        rows = rows[:page_size]
+        next_cursor = encode_page_cursor([rows[-1][key] for key in keys])
+    if rows:
+        output = Output(status=Status.SUCCESS, data=rows, optional={"next_cursor": next_cursor})
+    else:
+        output = Output(status=Status.WARNING, message=no_result_message, optional={"next_cursor": None})
+    return output.as_dict(optional=True)
+
+
+def encode_page_cursor(values):
+    """
+    Opaque token holding the keys of the last row of a page. Dates, decimals and UUIDs are kept
+    as text: Postgres casts the literals back to the type of the key column when comparing.
+    :param values: <list> Key values of the last row
+    :rtype: str
+    """
+    values = [value if value is None or isinstance(value, (bool, int, float, str))
+              else value.isoformat() if hasattr(value, "isoformat") else str(value)
+              for value in values]
+    return base64.urlsafe_b64encode(json.dumps(values, separators=(",", ":")).encode("utf-8")).decode("ascii")
+
+
+def decode_page_cursor(token):
+    """
+    :param token: <str> Token made by encode_page_cursor
+    :return: <list> Key values of the last row of the previous page
+    """
+    try:
+        values = json.loads(base64.urlsafe_b64decode(token.encode("ascii")).decode("utf-8"))
+    except (ValueError, binascii.Error, UnicodeError, AttributeError):
+        raise ValueError("Invalid cursor.")
+    if not isinstance(values, list):
+        raise ValueError("Invalid cursor.")
+    return values
+
+
+def _track_writes(db_key, tables, commit):
+    """Remembers the tables written in the current transaction and invalidates
+    their cached results once it is committed. The database is then read from
+    its primary until the end of the request."""
+    if tables or commit:
+        if "db_primary_only" not in g:
+            g.db_primary_only = set()
+        g.db_primary_only.add(db_key)
+    if "db_written_tables" not in g:
+        g.db_written_tables = {}
+    pending = g.db_written_tables.setdefault(db_key, set())
+    pending.update(tables)
+    if commit and pending:
+        query_cache.invalidate_tables(db_key, pending)
+        pending.clear()
+
+
+def execute_query_and_stream_output(db_key, query, query_data, itersize=2000, no_result_message="No data found.",
+                                    use_primary=False):
+    """
+    Streaming counterpart of execute_query_and_return_output for large result sets.
+    Rows are read through a named (server-side) cursor, ``itersize`` at a time, and written
+    into a chunked response with the same {"status": ..., "data": [...], "optional": ...}
+    envelope, so the whole result set is never held in memory. Clients accepting
+    application/x-ndjson get the envelope without data on the first line, then one row per line.
+    :param db_key: <str> Key to identify db in the config
+    :param query: <str> The query string, already properly formatted
+    :param query_data: <dict> the query parameters to be used
+    :param itersize: <int> Number of rows fetched from the server per round trip
+    :param no_result_message: <str> Message of the warning returned when there is no row
+    :param use_primary: <bool> Read from the primary even if the database has replicas
+    :return: The response to return from the route
+    :rtype: :class:`flask.Response`
+    """
+    cursor = None
+    # The slot covers the query and its first rows, not the time the client takes to read them
+    limiter = _admit(db_key)
+    try:
+        db_connection = get_read_db(db_key, use_primary or requires_primary(query))
+        cursor = db_connection.cursor(name="stream_{}".format(uuid.uuid4().hex),
+                                      cursor_factory=psycopg2.extras.RealDictCursor)
+        cursor.itersize = itersize
+        log_query(current_app.logger, "Streaming the following query: \n%s\nusing these params: %s", query,
+                  query_data)
+        cursor.execute(query, query_data)
+        rows = iter(cursor)
+        # The first row is read up front so errors and empty results still get a regular envelope
+        first_row = next(rows, None)
+    except (psycopg2.OperationalError, psycopg2.ProgrammingError) as pge:
+        current_app.logger.error(pge)
+        if cursor:
+            cursor.close()
+        return jsonify(Output(status=Status.ERROR, message=pge).as_dict())
+    finally:
+        if limiter is not None:
+            limiter.release()
+
+    if first_row is None:
+        cursor.close()
+        return jsonify(Output(status=Status.WARNING, message=no_result_message).as_dict())
+
+    envelope = Output(status=Status.SUCCESS).as_dict()
+    mimetype = negotiated_mimetype([JSON, NDJSON])
+    dumps = current_app.json.dumps
+
+    def generate_ndjson():
+        try:
+            yield dumps({"status": envelope["status"], "optional": envelope["optional"]}) + "\n"
+            chunk = [dumps(first_row)]
+            for row in rows:
+                chunk.append(dumps(row))
+                if len(chunk) >= itersize:
+                    yield "\n".join(chunk) + "\n"
+                    chunk = []
+            if chunk:
+                yield "\n".join(chunk) + "\n"
+        except psycopg2.Error as pge:
+            current_app.logger.error(pge, exc_info=True)
+            raise
+        finally:
+            cursor.close()
+
+    def generate():
+        try:
+            yield '{{"status": {}, "data": [{}'.format(dumps(envelope["status"]), dumps(first_row))
+            chunk = []
+            for row in rows:
+                chunk.append(dumps(row))
+                if len(chunk) >= itersize:
+                    yield ", " + ", ".join(chunk)
+                    chunk = []
+            if chunk:
+                yield ", " + ", ".join(chunk)
+            yield '], "optional": {}}}'.format(dumps(envelope["optional"]))
+        except psycopg2.Error as pge:
+            # Headers are already sent: the truncated body is the only way left to signal the error
+            current_app.logger.error(pge, exc_info=True)
+            raise
+        finally:
+            cursor.close()
+
+    if mimetype == NDJSON:
+        response = Response(stream_with_context(generate_ndjson()), mimetype=NDJSON)
+    else:
+        response = Response(stream_with_context(generate()), mimetype=JSON)
+    response.vary.add("Accept")
+    return response
+
+
+def execute_query(db_key, query, query_params=None, commit=False, fetch=None, fetch_all=None, check_result=False,
+                  prepare=None, use_primary=False, columnar=False, statement_timeout=None):
     """
     Executes the query on the specified database
     :param db_key: <str> Key to identify db in the config
@@ -88,27 +561,61 @@ def execute_query(db_key, query, query_params=None, commit=False, fetch=None, fe
     :param fetch: <bool> If set to true, returns the result of the query
     :param fetch_all: <bool> If set to true, returns the list of results of the query
     :param check_result: <bool> If set to true, checks if any result was returned by the query
+    :param prepare: <bool> If set to true, the query is prepared once per connection and run with EXECUTE.
+        Defaults to true when the database has a "PREPARED_STATEMENTS" entry in the config
+    :param use_primary: <bool> Run a read query on the primary even if the database has "REPLICAS".
+        Committed queries, queries writing to a table and those a replica refuses (nextval,
+        FOR UPDATE...) always run on the primary; pass it for functions writing to the database
+    :param columnar: <bool> Rows are fetched as plain tuples, and fetch_all returns
+        {"columns": [names], "rows": [tuples]} so column names are not repeated in every row
+    :param statement_timeout: <int> Milliseconds after which the server cancels the query. The previous
+        timeout is restored once the query ran. Defaults to the "STATEMENT_TIMEOUT" of the database
+        (or DB_STATEMENT_TIMEOUT), set once per connection
     """
     result = None
     db_connection = None
     cursor = None
+    rows = 0
+    failed = True
+    previous_timeout = None
+    limiter = _admit(db_key)
+    started = time.perf_counter()
     try:
-        db_connection = get_db(db_key)
-        cursor = db_connection.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
-        current_app.logger.debug("Executing the following query: \n{}\nusing these params: {}".format(query,
-                                                                                                      query_params))
-        cursor.execute(query, query_params)
+        tables = written_tables(query)
+        if commit or tables or requires_primary(query):
+            db_connection = get_db(db_key)
+        else:
+            db_connection = get_read_db(db_key, use_primary)
+        cursor = db_connection.cursor(cursor_factory=None if columnar else psycopg2.extras.RealDictCursor)
+        log_query(current_app.logger, "Executing the following query: \n%s\nusing these params: %s", query,
+                  query_params)
+        if statement_timeout is not None:
+            previous_timeout = _set_statement_timeout(cursor, statement_timeout)
+        prepared_config = current_app.config["DATABASE"][db_key].get("PREPARED_STATEMENTS")
+        if prepare or (prepare is None and prepared_config):
+            execute_prepared(cursor, query, query_params, (prepared_config or {}).get("MAX_SIZE", 100))
+        else:
+            cursor.execute(query, query_params)
         if commit:
             db_connection.commit()
+        _track_writes(db_key, tables, commit)
         if fetch:
             result = cursor.fetchone()
+            rows = 1 if result else 0
         elif fetch_all:
             result = cursor.fetchall()
+            rows = len(result)
+            if columnar:
+                result = {"columns": [column[0] for column in cursor.description], "rows": result}
+        else:
+            rows = max(cursor.rowcount, 0)
+        if previous_timeout is not None and not commit:
+            _restore_statement_timeout(cursor, previous_timeout)
         if check_result:
             assert result
+        failed = False
     except (psycopg2.OperationalError, psycopg2.InterfaceError, psycopg2.ProgrammingError, AssertionError) as pge:
-        current_app.logger.error(pge)
-        current_app.logger.error(traceback.format_exc())
+        current_app.logger.error(pge, exc_info=True)
         if commit and db_connection:
             db_connection.rollback()
         if cursor:
@@ -117,13 +624,121 @@ def execute_query(db_key, query, query_params=None, commit=False, fetch=None, fe
     finally:
         if cursor:
             cursor.close()
+        if limiter is not None:
+            limiter.release()
+        _record_query(db_key, query, time.perf_counter() - started, rows, failed)
     return result
 
 
+def execute_queries(db_key, statements, commit=True, statement_timeout=None):
+    """
+    Executes several statements in one transaction, with as few round trips as possible:
+    statements whose result is not fetched are sent together with the next one, so a
+    round trip is only made per fetched result (and one for the trailing statements).
+    Everything is rolled back if any statement fails.
+    :param db_key: <str> Key to identify db in the config
+    :param statements: <list> (query, params) or (query, params, mode) tuples, mode being
+        None, "fetch" or "fetch_all" as for execute_query
+    :param commit: <bool> Specifies whether to commit the transaction once all statements ran
+    :param statement_timeout: <int> Milliseconds after which the server cancels a statement, see execute_query
+    :return: <list> The result of each statement: None, a row or a list of rows
+    """
+    results = []
+    db_connection = None
+    cursor = None
+    tables = set()
+    previous_timeout = None
+    limiter = _admit(db_key)
+    try:
+        db_connection = get_db(db_key)
+        cursor = db_connection.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
+        if statement_timeout is not None:
+            previous_timeout = _set_statement_timeout(cursor, statement_timeout)
+        pending = []
+        pending_queries = []
+        for index, statement in enumerate(statements):
+            query, params = statement[0], statement[1]
+            mode = statement[2] if len(statement) > 2 else None
+            if mode not in (None, "fetch", "fetch_all"):
+                raise ValueError("Unknown fetch mode {!r} for statement {}".format(mode, index))
+            pending.append(cursor.mogrify(query, params))
+            pending_queries.append(query)
+            tables.update(written_tables(query))
+            results.append(None)
+            if mode is not None or index == len(statements) - 1:
+                _execute_batch(db_key, cursor, pending, pending_queries)
+                if mode == "fetch":
+                    results[-1] = cursor.fetchone()
+                elif mode == "fetch_all":
+                    results[-1] = cursor.fetchall()
+                pending = []
+                pending_queries = []
+        if commit:
+            db_connection.commit()
+        elif previous_timeout is not None:
+            _restore_statement_timeout(cursor, previous_timeout)
+        _track_writes(db_key, tables, commit)
+    except (psycopg2.Error, ValueError) as pge:
+        current_app.logger.error(pge, exc_info=True)
+        if db_connection:
+            db_connection.rollback()
+        raise
+    finally:
+        if cursor:
+            cursor.close()
+        if limiter is not None:
+            limiter.release()
+    return results
+
+
+def _set_statement_timeout(cursor, statement_timeout):
+    """
+    Sets the statement timeout for the current transaction only.
+    :return: <str> The timeout in effect before, to give to _restore_statement_timeout
+    """
+    cursor.execute("SELECT current_setting('statement_timeout') AS previous, "
+                   "set_config('statement_timeout', %s, true)", (str(int(statement_timeout)),))
+    row = cursor.fetchone()
+    return row["previous"] if isinstance(row, dict) else row[0]
+
+
+def _restore_statement_timeout(cursor, previous_timeout):
+    # Otherwise the timeout holds until the end of the transaction, for the next queries of the request
+    if cursor.connection.get_transaction_status() == psycopg2.extensions.TRANSACTION_STATUS_INTRANS:
+        cursor.execute("SELECT set_config('statement_timeout', %s, true)", (previous_timeout,))
+
+
+def _execute_batch(db_key, cursor, sql_statements, queries):
+    """Sends the already bound statements in a single execute; only the result of the last one is readable."""
+    # The separator is on its own line so a trailing "-- comment" cannot swallow it
+    query = "\n;\n".join(queries)
+    log_query(current_app.logger, "Executing the following statements: \n%s", query)
+    rows = 0
+    failed = True
+    started = time.perf_counter()
+    try:
+        cursor.execute(b"\n;\n".join(sql_statements))
+        rows = max(cursor.rowcount, 0)
+        failed = False
+    finally:
+        _record_query(db_key, query, time.perf_counter() - started, rows, failed)
+
+
+def _record_query(db_key, query, duration, rows, failed):
+    # Per request total, reported in the Server-Timing header
+    g.db_time = g.get("db_time", 0.0) + duration
+    fingerprint = query_fingerprint(query)
+    metrics.db_query_duration.observe(duration, db_key, fingerprint)
+    if rows:
+        metrics.db_query_rows.inc(db_key, fingerprint, amount=rows)
+    if failed:
+        metrics.db_query_errors.inc(db_key, fingerprint)
+
+
 def generate_insert_query(table_name, insert_data, returning=None, multiple=False):
     """Creates the insert query string"""
     if multiple:
-        query = """"
+        query = """
             INSERT INTO {} 
             ({}) 
             VALUES %s
@@ -167,6 +782,125 @@ def _insert_notation_values(insert_data):
     return ", ".join(values)
 
 
+def bulk_insert(db_key, table_name, rows, columns=None, batch_size=1000, method="values", returning=None,
+                commit=True):
+    """
+    Inserts many rows using as few round trips as possible.
+    With the "values" method, rows are sent as multi-row INSERT statements of ``batch_size`` rows
+    (psycopg2's execute_values). With the "copy" method, they are streamed through COPY FROM STDIN,
+    which is the fastest way but cannot return anything.
+    As with generate_insert_query, list and dict values are stored as JSONB.
+    :param db_key: <str> Key to identify db in the config
+    :param table_name: <str> Table to insert into
+    :param rows: <iterable> dicts, or tuples when columns is given. Consumed lazily, batch by batch
+    :param columns: <list> Column names; taken from the keys of the first row when not given
+    :param batch_size: <int> Number of rows sent per statement (or per COPY buffer)
+    :param method: <str> "values" or "copy"
+    :param returning: <str> RETURNING clause content (only with the "values" method)
+    :param commit: <bool> Specifies whether the transaction is committed
+    :return: The number of inserted rows, or the list of returned rows when returning is set
+    """
+    if method not in ("values", "copy"):
+        raise ValueError("Unknown bulk insert method '{}'".format(method))
+    if returning and method == "copy":
+        raise ValueError("RETURNING is not available with the COPY method")
+
+    rows = iter(rows)
+    first_batch = list(itertools.islice(rows, batch_size))
+    if not first_batch:
+        return [] if returning else 0
+    if columns is None:
+        if not isinstance(first_batch[0], dict):
+            raise ValueError("columns must be given when rows are not dicts")
+        columns = list(first_batch[0].keys())
+
+    # A column is JSONB as soon as one value of the first batch is a list or a dict
+    jsonb_columns = set()
+    for row in first_batch:
+        values = [row[c] for c in columns] if isinstance(row, dict) else row
+        jsonb_columns.update(c for c, v in zip(columns, values) if type(v) in [list, dict])
+
+    def prepared_rows():
+        for row in itertools.chain(first_batch, rows):
+            values = [row[c] for c in columns] if isinstance(row, dict) else row
+            yield [json.dumps(v) if type(v) in [list, dict] else v for v in values]
+
+    db_connection = None
+    cursor = None
+    limiter = _admit(db_key)
+    try:
+        db_connection = get_db(db_key)
+        cursor = db_connection.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
+        current_app.logger.debug("Bulk inserting into %s (%s) with the %s method", table_name, columns, method)
+        if method == "copy":
+            copy_query = "COPY {} ({}) FROM STDIN WITH (FORMAT csv)".format(table_name, ", ".join(columns))
+            cursor.copy_expert(copy_query, _CsvRowsReader(prepared_rows()), size=64 * 1024)
+            result = cursor.rowcount
+        else:
+            query = "INSERT INTO {} ({}) VALUES %s".format(table_name, ", ".join(columns))
+            if returning:
+                query += " RETURNING {}".format(returning)
+            template = "({})".format(", ".join("%s::JSONB" if c in jsonb_columns else "%s" for c in columns))
+            result = [] if returning else 0
+            data = prepared_rows()
+            batches = iter(lambda: list(itertools.islice(data, batch_size)), [])
+            for batch in batches:
+                returned = psycopg2.extras.execute_values(cursor, query, batch, template=template,
+                                                          page_size=batch_size, fetch=bool(returning))
+                if returning:
+                    result.extend(returned)
+                else:
+                    result += cursor.rowcount
+        if commit:
+            db_connection.commit()
+        _track_writes(db_key, [table_name], commit)
+    except psycopg2.Error as pge:
+        current_app.logger.error(pge, exc_info=True)
+        if db_connection:
+            db_connection.rollback()
+        raise
+    finally:
+        if cursor:
+            cursor.close()
+        if limiter is not None:
+            limiter.release()
+    return result
+
+
+class _CsvRowsReader(io.TextIOBase):
+    """Read-only file object turning an iterator of rows into CSV text, as COPY FROM STDIN expects."""
+
+    def __init__(self, rows):
+        self._rows = rows
+        self._pending = ""
+
+    @staticmethod
+    def _field(value):
+        # COPY reads an unquoted empty field as NULL and a quoted one as an empty string
+        if value is None:
+            return ""
+        return '"{}"'.format(str(value).replace('"', '""'))
+
+    def readable(self):
+        return True
+
+    def read(self, size=-1):
+        lines = [self._pending]
+        length = len(self._pending)
+        while size < 0 or length < size:
+            row = next(self._rows, None)
+            if row is None:
+                break
+            line = ",".join(self._field(v) for v in row) + "\n"
+            lines.append(line)
+            length += len(line)
+        pending = "".join(lines)
+        if size < 0:
+            size = length
+        chunk, self._pending = pending[:size], pending[size:]
+        return chunk
+
+
 def query_sequence_next_id():
     """
         Build the query to retrieves the next available id from the sequence name
@@ -174,3 +908,118 @@ def query_sequence_next_id():
 
     query_next_sequence = """SELECT NEXTVAL(%(sequence_name)s) AS id;"""
     return query_next_sequence
+
+
+def query_sequence_next_ids():
+    """
+        Build the query reserving several ids of the sequence name in one round trip
+    """
+
+    query_next_sequence_ids = """SELECT NEXTVAL(%(sequence_name)s) AS id FROM generate_series(1, %(count)s);"""
+    return query_next_sequence_ids
+
+
+def next_id(db_key, sequence_name):
+    """
+    Next id of a sequence, without a round trip per id: ids are reserved by blocks of
+    "ID_BLOCK_SIZE" (config of the database, 100 by default) and the next block is fetched
+    in the background before the current one runs out. Ids are unique but, across threads
+    and processes, not handed out in order.
+    :param db_key: <str> Key to identify db in the config
+    :param sequence_name: <str> Name of the sequence
+    :rtype: int
+    """
+    key = (db_key, sequence_name)
+    allocator = _id_allocators.get(key)
+    if allocator is None:
+        app = current_app._get_current_object()
+        block_size = app.config["DATABASE"][db_key].get("ID_BLOCK_SIZE", 100)
+        with _pools_lock:
+            allocator = _id_allocators.get(key)
+            if allocator is None:
+                allocator = IdBlockAllocator(lambda count: _fetch_ids(app, db_key, sequence_name, count),
+                                             block_size=block_size)
+                _id_allocators[key] = allocator
+    return allocator.next_id()
+
+
+def _fetch_ids(app, db_key, sequence_name, count):
+    if not has_app_context():
+        # Background refill: its connection is given back when the context ends
+        with app.app_context():
+            return _fetch_ids(app, db_key, sequence_name, count)
+    # nextval cannot run on a read replica
+    rows = execute_query(db_key, query_sequence_next_ids(), {"sequence_name": sequence_name, "count": count},
+                         fetch_all=True, use_primary=True)
+    return [row["id"] for row in rows]
+
+
+def queue_insert(db_key, table_name, row):
+    """
+    Fire-and-forget insert: the row is queued and written later by a background thread, in
+    multi-row inserts of up to "MAX_BATCH" rows sent at least every "FLUSH_INTERVAL" seconds
+    ("WRITE_BEHIND" dict of the database config). Rows still queued are written at exit.
+    Only for rows nobody reads back in the same request (audit, events...): a failed batch
+    is logged and counted, never reported to the caller. While the database is saturated
+    (see "ADMISSION"), batches wait for it instead of failing.
+    :param db_key: <str> Key to identify db in the config
+    :param table_name: <str> Table to insert into
+    :param row: <dict> Column -> value; rows of a table must all have the same columns
+    :raise ValueError: The row does not have the columns of the first row queued for the table
+    """
+    try:
+        get_write_behind(db_key, table_name).put(row)
+    except queue.Full:
+        current_app.logger.warning("Write-behind queue of %s.%s full", db_key, table_name)
+        raise ApiErrorException("Too many writes queued for {}, retry later.".format(table_name), 503)
+
+
+def get_write_behind(db_key, table_name):
+    """
+    :return: The write-behind buffer of a table, created on first use
+    :rtype: :class:`modules.lib.write_behind.WriteBehindBuffer`
+    """
+    key = (db_key, table_name)
+    buffer = _write_behind.get(key)
+    if buffer is None:
+        app = current_app._get_current_object()
+        config = app.config["DATABASE"][db_key].get("WRITE_BEHIND") or {}
+        with _pools_lock:
+            buffer = _write_behind.get(key)
+            if buffer is None:
+                buffer = WriteBehindBuffer(
+                    "{}.{}".format(db_key, table_name),
+                    lambda rows: _flush_write_behind(app, db_key, table_name, rows),
+                    max_batch=config.get("MAX_BATCH", 500),
+                    flush_interval=config.get("FLUSH_INTERVAL", 1.0),
+                    max_queue=config.get("MAX_QUEUE", 10000),
+                    put_timeout=config.get("PUT_TIMEOUT", 0.5),
+                )
+                atexit.register(buffer.close)
+                _write_behind[key] = buffer
+    return buffer
+
+
+def _flush_write_behind(app, db_key, table_name, rows):
+    delay = 0.05
+    with app.app_context():
+        while True:
+            try:
+                bulk_insert(db_key, table_name, rows, batch_size=len(rows))
+                return
+            except ApiErrorException as e:
+                if e.status_code != 503:
+                    raise
+            # The database is saturated: the batch waits for it rather than being dropped, and
+            # the queue filling up meanwhile slows queue_insert callers down
+            time.sleep(delay)
+            delay = min(delay * 2, 1.0)
+
+
+def close_write_behind():
+    """Write the rows queued in every write-behind buffer and stop their threads."""
+    with _pools_lock:
+        buffers = list(_write_behind.values())
+        _write_behind.clear()
+    for buffer in buffers:
+        buffer.close()
@@ -2,8 +2,6 @@ from enum import Enum, unique
 import json
 import traceback
 
-from modules.lib.decimal_encoder import DecimalEncoder
-
 
 @unique
 class Status(Enum):
@@ -19,6 +17,12 @@ class Status(Enum):
 
 
 class Output:
+    """
+    Envelope returned by the routes. The payload is kept as given (Decimals included)
+    and is only serialized once, by the app's JSON provider, when the response is built.
+    """
+    __slots__ = ("_status", "title", "message", "code", "_data", "enable_trace", "optional")
+
     def __init__(
             self,
             status=Status.UNKNOWN,
@@ -27,7 +31,7 @@ class Output:
             code="",
             data="",
             trace=False,
-            optional={},
+            optional=None,
     ):
         self.status = status
         self.title = title
@@ -35,7 +39,7 @@ class Output:
         self.code = code
         self.data = data
         self.enable_trace = trace
-        self.optional = optional
+        self.optional = optional if type(optional) is dict else {}
 
     @property
     def status(self):
@@ -44,10 +48,7 @@ class Output:
     @status.setter
     def status(self, value):
         if isinstance(value, Status):
-            if value in Status:
-                self._status = value
-            else:
-                self._status = Status.UNKNOWN
+            self._status = value
         else:
             for status in Status:
                 if value == status.value:
@@ -56,30 +57,6 @@ class Output:
             else:
                 self._status = Status.UNKNOWN
 
-    @property
-    def title(self):
-        return self._title
-
-    @title.setter
-    def title(self, value):
-        self._title = str(value)
-
-    @property
-    def message(self):
-        return self._message
-
-    @message.setter
-    def message(self, value):
-        self._message = str(value)
-
-    @property
-    def code(self):
-        return self._code
-
-    @code.setter
-    def code(self, value):
-        self._code = str(value)
-
     @property
     def data(self):
         return self._data
@@ -89,39 +66,22 @@ class Output:
         if not value:
             self._data = ""
         elif type(value) is dict or type(value) is list:
-            self._data = json.loads(json.dumps(value, cls=DecimalEncoder), encoding='utf-8')
+            self._data = value
         else:
-            try:
-                self._data = json.loads(value, encoding='utf-8')
-            except json.decoder.JSONDecodeError:
-                raise
+            self._data = json.loads(value)
 
     @property
     def trace(self):
         trace = traceback.format_exc()
         return trace
 
-    @property
-    def optional(self):
-        return self._optional
-
-    @optional.setter
-    def optional(self, value):
-        if type(value) is dict:
-            self._optional = value
-        else:
-            try:
-                self._optional = self.optional
-            except AttributeError:
-                self._optional = {}
-
     def as_dict(self, optional=False, trace=None):
         temp = {
             "status": {
                 "name": self.status.value,
-                "title": self.title,
-                "message": self.message,
-                "code": self.code,
+                "title": str(self.title),
+                "message": str(self.message),
+                "code": str(self.code),
                 "trace": None,
             },
             "data": {},
@@ -134,7 +94,7 @@ class Output:
         if (trace is not None and trace) or (
                 trace is None and self.enable_trace
         ):
-            temp["status"]["trace"] = self.trace.encode('UTF-8')
+            temp["status"]["trace"] = self.trace
         else:
             temp["status"]["trace"] = None
         return temp
@@ -0,0 +1,61 @@
+import collections
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+class IdBlockAllocator:
+    """
+    Hands out ids of a sequence from blocks reserved in one query (hi/lo).
+
+    ``fetch_block(count)`` must return ``count`` fresh values of the sequence.
+    Once no more than ``low_water`` ids are left, the next block is fetched by a
+    background thread, so callers only wait on the database when the block runs
+    out faster than it is refilled. Ids that are never handed out (process exit)
+    are lost, leaving gaps in the sequence, as a rolled back nextval would.
+    """
+
+    def __init__(self, fetch_block, block_size=100, low_water=None):
+        if block_size < 1:
+            raise ValueError("Invalid block size: {}".format(block_size))
+        self.fetch_block = fetch_block
+        self.block_size = block_size
+        self.low_water = block_size // 5 if low_water is None else low_water
+
+        self._cond = threading.Condition()
+        self._ids = collections.deque()
+        self._refilling = False
+
+    def next_id(self):
+        """:rtype: int"""
+        with self._cond:
+            while not self._ids:
+                if self._refilling:
+                    self._cond.wait()
+                else:
+                    # Callers arriving meanwhile wait for this block instead of fetching their own
+                    self._ids.extend(sorted(self.fetch_block(self.block_size)))
+            value = self._ids.popleft()
+            if len(self._ids) <= self.low_water and not self._refilling:
+                self._refilling = True
+                threading.Thread(target=self._refill, name="id-refill", daemon=True).start()
+            return value
+
+    def _refill(self):
+        ids = []
+        try:
+            ids = sorted(self.fetch_block(self.block_size))
+        except Exception:
+            # The next caller finding the block empty fetches it itself
+            logger.exception("Background refill of an id block failed")
+        finally:
+            with self._cond:
+                self._ids.extend(ids)
+                self._refilling = False
+                self._cond.notify_all()
+
+    @property
+    def stats(self):
+        with self._cond:
+            return {"available": len(self._ids), "refilling": self._refilling}
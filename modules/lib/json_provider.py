@@ -0,0 +1,97 @@
+import base64
+import datetime
+import decimal
+import time
+import uuid
+
+from flask import g, has_app_context, has_request_context
+from flask.json.provider import DefaultJSONProvider
+
+from modules.lib.negotiation import JSON, MSGPACK, msgpack_dumps, ndjson_items, negotiated_mimetype
+
+try:
+    import orjson
+except ImportError:  # the stdlib json module is used when orjson is not installed
+    orjson = None
+
+
+def default(o):
+    """Types returned by psycopg2 that JSON has no native type for."""
+    if isinstance(o, decimal.Decimal):
+        return float(o)
+    if isinstance(o, (datetime.datetime, datetime.date, datetime.time)):
+        return o.isoformat()
+    if isinstance(o, uuid.UUID):
+        return str(o)
+    if isinstance(o, (memoryview, bytes, bytearray)):
+        # bytea columns
+        return base64.b64encode(o).decode("ascii")
+    return DefaultJSONProvider.default(o)
+
+
+def _add_serialization_time(started):
+    # Per request total, reported in the Server-Timing header
+    if has_app_context():
+        g.serialization_time = g.get("serialization_time", 0.0) + time.perf_counter() - started
+
+
+class AppJSONProvider(DefaultJSONProvider):
+    """JSON provider installed by create_app, so payloads are encoded once, straight from Python objects.
+    Encoding is done by orjson when it is installed, by the json module otherwise; both give the same
+    output for Decimal (number), dates (ISO 8601), UUID and bytea (base64) values.
+    Responses built with jsonify are encoded as JSON, NDJSON or MessagePack depending on the Accept header."""
+
+    default = staticmethod(default)
+
+    def _orjson_option(self, indent=None):
+        option = orjson.OPT_NON_STR_KEYS
+        if self.sort_keys:
+            option |= orjson.OPT_SORT_KEYS
+        if indent:
+            option |= orjson.OPT_INDENT_2
+        return option
+
+    def _encode(self, obj, indent=None):
+        """UTF-8 JSON, compact unless indented, without the timing done by dumps.
+        Values orjson refuses (integers beyond 64 bits...) are left to the json module, which
+        does not escape non-ASCII characters either, so both give the same bytes."""
+        if orjson is not None:
+            try:
+                return orjson.dumps(obj, default=default, option=self._orjson_option(indent))
+            except orjson.JSONEncodeError:
+                pass
+        if indent:
+            return super(AppJSONProvider, self).dumps(obj, indent=indent, ensure_ascii=False).encode("utf-8")
+        return super(AppJSONProvider, self).dumps(obj, separators=(",", ":"), ensure_ascii=False).encode("utf-8")
+
+    def dumps(self, obj, **kwargs):
+        started = time.perf_counter()
+        try:
+            if orjson is not None and not kwargs.keys() - {"indent", "separators"}:
+                return self._encode(obj, kwargs.get("indent")).decode("utf-8")
+            return super(AppJSONProvider, self).dumps(obj, **kwargs)
+        finally:
+            _add_serialization_time(started)
+
+    def loads(self, s, **kwargs):
+        if orjson is not None and not kwargs:
+            return orjson.loads(s)
+        return super(AppJSONProvider, self).loads(s, **kwargs)
+
+    def response(self, *args, **kwargs):
+        mimetype = negotiated_mimetype() if has_request_context() else JSON
+        obj = self._prepare_response_obj(args, kwargs)
+        started = time.perf_counter()
+        if mimetype == MSGPACK:
+            body = msgpack_dumps(obj)
+        elif mimetype == JSON:
+            indent = None
+            if self.compact is False or (self.compact is None and self._app.debug):
+                indent = 2
+            body = self._encode(obj, indent) + b"\n"
+        else:
+            body = b"".join(self._encode(item) + b"\n" for item in ndjson_items(obj))
+        _add_serialization_time(started)
+        response = self._app.response_class(body, mimetype=mimetype)
+        response.vary.add("Accept")
+        return response
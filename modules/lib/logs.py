@@ -0,0 +1,126 @@
+import atexit
+import logging
+import os
+import random
+
+from logging.handlers import QueueHandler, QueueListener
+from queue import Queue
+
+LOG_FORMAT = "%(asctime)s [%(threadName)-10s] - %(levelname)s - %(module)s.%(funcName)s(%(lineno)d): %(message)s"
+
+_settings = {"sample_rate": 1.0, "max_chars": 2000}
+_state = {"listener": None}
+
+
+def setup_queued_logging(level, filename=None):
+    """
+    Configure the root logger like logging.basicConfig would, except that records are put on a
+    queue and written to the file (or stderr) by a listener thread, so request threads never
+    wait on disk I/O. Nothing is done if the root logger already has handlers.
+    :return: The started listener, or None
+    :rtype: :class:`logging.handlers.QueueListener`
+    """
+    root = logging.getLogger()
+    if root.handlers:
+        return None
+    handler = logging.FileHandler(filename) if filename else logging.StreamHandler()
+    handler.setFormatter(logging.Formatter(LOG_FORMAT))
+    log_queue = Queue(-1)
+    root.addHandler(QueueHandler(log_queue))
+    root.setLevel(level)
+    listener = QueueListener(log_queue, handler, respect_handler_level=True)
+    listener.start()
+    _state["listener"] = listener
+    atexit.register(stop_listener)
+    os.register_at_fork(before=_lock_handlers, after_in_parent=_unlock_handlers,
+                        after_in_child=_restart_after_fork)
+    return listener
+
+
+def _lock_handlers():
+    # Fork only while the listener is not writing, or the child inherits a half-written stream
+    listener = _state["listener"]
+    if listener is not None:
+        for handler in listener.handlers:
+            handler.acquire()
+
+
+def _unlock_handlers():
+    listener = _state["listener"]
+    if listener is not None:
+        for handler in listener.handlers:
+            handler.release()
+
+
+def _restart_after_fork():
+    """
+    The listener thread does not survive a fork, and the inherited queue still holds the
+    parent's pending records and waiters: the child logs through a new queue and listener.
+    The handler locks were already reset by the logging module in the child.
+    """
+    listener = _state["listener"]
+    if listener is None:
+        return
+    log_queue = Queue(-1)
+    for handler in logging.getLogger().handlers:
+        if isinstance(handler, QueueHandler) and handler.queue is listener.queue:
+            handler.queue = log_queue
+    restarted = QueueListener(log_queue, *listener.handlers, respect_handler_level=True)
+    restarted.start()
+    _state["listener"] = restarted
+
+
+def stop_listener():
+    """Write the queued records and stop the listener of this process."""
+    listener, _state["listener"] = _state["listener"], None
+    if listener is not None:
+        listener.stop()
+
+
+def configure_query_logging(sample_rate=1.0, max_chars=2000):
+    """
+    :param sample_rate: <float> Share (0 to 1) of the queries whose text and result are logged
+    :param max_chars: <int> Size above which logged values are cut
+    """
+    _settings["sample_rate"] = sample_rate
+    _settings["max_chars"] = max_chars
+
+
+class Truncated:
+    """Log argument rendered only if the record is emitted, and cut to a maximum size.
+    Lists are rendered item by item, so a large result set is never stringified as a whole."""
+    __slots__ = ("value", "max_chars")
+
+    def __init__(self, value, max_chars):
+        self.value = value
+        self.max_chars = max_chars
+
+    def __str__(self):
+        if isinstance(self.value, (list, tuple)):
+            parts = []
+            length = 0
+            for item in self.value:
+                part = str(item)
+                parts.append(part)
+                length += len(part) + 2
+                if length > self.max_chars:
+                    break
+            text = "[" + ", ".join(parts) + "]"
+            if len(parts) < len(self.value) or len(text) > self.max_chars:
+                return "{}... ({} items)".format(text[:self.max_chars], len(self.value))
+            return text
+        text = str(self.value)
+        if len(text) > self.max_chars:
+            return "{}... ({} chars)".format(text[:self.max_chars], len(text))
+        return text
+
+
+def log_query(logger, message, *args):
+    """Log query text/params/results at DEBUG level, sampled and size-capped. Nothing is
+    formatted when DEBUG is off or the query is not part of the sample."""
+    if not logger.isEnabledFor(logging.DEBUG):
+        return
+    sample_rate = _settings["sample_rate"]
+    if sample_rate < 1.0 and random.random() >= sample_rate:
+        return
+    logger.debug(message, *(Truncated(arg, _settings["max_chars"]) for arg in args), stacklevel=2)
@@ -0,0 +1,255 @@
+import bisect
+import fcntl
+import hashlib
+import json
+import os
+import re
+import threading
+
+from functools import lru_cache
+
+# Seconds; covers fast index lookups up to slow reports
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+_STRING_LITERAL = re.compile(r"'(?:[^']|'')*'")
+_NUMBER_LITERAL = re.compile(r"\b\d+(?:\.\d+)?\b")
+_PLACEHOLDER = re.compile(r"%\(\w+\)s|%s")
+_IN_LIST = re.compile(r"\(\s*\?(?:\s*,\s*\?)+\s*\)")
+_SPACES = re.compile(r"\s+")
+
+
+@lru_cache(maxsize=2048)
+def query_fingerprint(query):
+    """
+    Normalized identifier of a query: literals and placeholders are replaced by "?" and
+    whitespace is collapsed, so the same statement with other parameters shares its metrics.
+    :return: The first keyword of the query followed by a short hash, e.g. "select_3f2a9c1b"
+    """
+    normalized = _STRING_LITERAL.sub("?", query)
+    normalized = _PLACEHOLDER.sub("?", normalized)
+    normalized = _NUMBER_LITERAL.sub("?", normalized)
+    normalized = _IN_LIST.sub("(?)", normalized)
+    normalized = _SPACES.sub(" ", normalized).strip().rstrip(";").strip().lower()
+    keyword = normalized.split(" ", 1)[0] if normalized else "empty"
+    return "{}_{}".format(keyword, hashlib.sha1(normalized.encode("utf-8")).hexdigest()[:8])
+
+
+def _format_labels(names, values, extra=None):
+    pairs = list(zip(names, values))
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join('{}="{}"'.format(k, str(v).replace("\\", "\\\\").replace('"', '\\"'))
+                          for k, v in pairs) + "}"
+
+
+class Counter:
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *label_values, amount=1):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def snapshot(self):
+        with self._lock:
+            return dict(self._values)
+
+    @staticmethod
+    def merge(total, values):
+        for label_values, value in values.items():
+            total[label_values] = total.get(label_values, 0) + value
+
+    def render(self, values=None):
+        """:param values: <dict> Values to render (see Registry.render), those of this process by default"""
+        lines = ["# HELP {} {}".format(self.name, self.documentation), "# TYPE {} counter".format(self.name)]
+        values = sorted((self.snapshot() if values is None else values).items())
+        for label_values, value in values:
+            lines.append("{}{} {}".format(self.name, _format_labels(self.labels, label_values), value))
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, documentation, labels=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        self._values = {}  # label values -> [per bucket counts (+Inf last), sum, count]
+        self._lock = threading.Lock()
+
+    def observe(self, value, *label_values):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._values.get(label_values)
+            if series is None:
+                series = self._values[label_values] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    def snapshot(self):
+        with self._lock:
+            return {k: [list(v[0]), v[1], v[2]] for k, v in self._values.items()}
+
+    @staticmethod
+    def merge(total, values):
+        for label_values, (counts, value_sum, count) in values.items():
+            series = total.get(label_values)
+            if series is None:
+                total[label_values] = [list(counts), value_sum, count]
+            else:
+                series[0] = [a + b for a, b in zip(series[0], counts)]
+                series[1] += value_sum
+                series[2] += count
+
+    def render(self, values=None):
+        """:param values: <dict> Values to render (see Registry.render), those of this process by default"""
+        lines = ["# HELP {} {}".format(self.name, self.documentation), "# TYPE {} histogram".format(self.name)]
+        values = sorted((self.snapshot() if values is None else values).items())
+        for label_values, (counts, total, count) in values:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + ("+Inf",), counts):
+                cumulative += bucket_count
+                lines.append("{}_bucket{} {}".format(
+                    self.name, _format_labels(self.labels, label_values, ("le", bound)), cumulative))
+            lines.append("{}_sum{} {}".format(self.name, _format_labels(self.labels, label_values), total))
+            lines.append("{}_count{} {}".format(self.name, _format_labels(self.labels, label_values), count))
+        return lines
+
+
+class Registry:
+    """
+    Metrics of the service. Under a pre-fork server each worker only sees its own
+    requests: once use_directory was called, every process regularly writes its values
+    into a file of that directory and render sums the values found in all of them.
+    """
+
+    ARCHIVE = "metrics-archive.json"
+
+    def __init__(self):
+        self._metrics = []
+        self.directory = None
+        self._stop_writer = None
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def use_directory(self, directory):
+        """Share the metrics of the processes forked from now on through the files of directory,
+        removing those left by a previous run."""
+        os.makedirs(directory, exist_ok=True)
+        for name in os.listdir(directory):
+            if name.startswith("metrics-") and name.endswith(".json"):
+                os.remove(os.path.join(directory, name))
+        self.directory = directory
+
+    def _path(self, name):
+        return os.path.join(self.directory, name)
+
+    def _lock_directory(self, operation):
+        lock = open(self._path(".lock"), "a")
+        fcntl.flock(lock, operation)
+        return lock
+
+    def write(self):
+        """Write the values of this process into its file of the shared directory."""
+        if self.directory is None:
+            return
+        data = {metric.name: [[list(k), v] for k, v in metric.snapshot().items()] for metric in self._metrics}
+        path = self._path("metrics-{}.json".format(os.getpid()))
+        temporary = "{}.{}.tmp".format(path, threading.get_ident())
+        with open(temporary, "w") as f:
+            json.dump(data, f)
+        # Readers never see a half-written file
+        os.replace(temporary, path)
+
+    def start_writer(self, interval=5.0):
+        """Write the values of this process every interval seconds, in a background thread."""
+        if self.directory is None or self._stop_writer is not None:
+            return
+        self._stop_writer = threading.Event()
+
+        def run(stop):
+            while not stop.wait(interval):
+                self.write()
+
+        threading.Thread(target=run, args=(self._stop_writer,), name="metrics-writer", daemon=True).start()
+
+    def stop_writer(self):
+        """Stop the background writes and write the final values of this process."""
+        if self._stop_writer is not None:
+            self._stop_writer.set()
+            self._stop_writer = None
+        self.write()
+
+    def collect(self, pid):
+        """
+        Add the values of an exited process to the archive and remove its file,
+        so counters keep growing when workers are replaced.
+        """
+        if self.directory is None:
+            return
+        path = self._path("metrics-{}.json".format(pid))
+        with self._lock_directory(fcntl.LOCK_EX):
+            if not os.path.exists(path):
+                return
+            totals = self._read([self.ARCHIVE, os.path.basename(path)])
+            data = {metric.name: [[list(k), v] for k, v in total.items()]
+                    for metric, total in zip(self._metrics, totals)}
+            with open(self._path(self.ARCHIVE + ".tmp"), "w") as f:
+                json.dump(data, f)
+            os.replace(self._path(self.ARCHIVE + ".tmp"), self._path(self.ARCHIVE))
+            os.remove(path)
+
+    def _read(self, names):
+        """Sum of the values stored in the files, one dict per metric."""
+        totals = [{} for _ in self._metrics]
+        for name in names:
+            try:
+                with open(self._path(name)) as f:
+                    data = json.load(f)
+            except FileNotFoundError:
+                continue
+            for metric, total in zip(self._metrics, totals):
+                metric.merge(total, {tuple(k): v for k, v in data.get(metric.name, ())})
+        return totals
+
+    def render(self):
+        """
+        :return: Every metric in the Prometheus text exposition format
+        :rtype: :class:`str`
+        """
+        if self.directory is None:
+            totals = [metric.snapshot() for metric in self._metrics]
+        else:
+            self.write()
+            with self._lock_directory(fcntl.LOCK_SH):
+                totals = self._read([name for name in os.listdir(self.directory)
+                                     if name.startswith("metrics-") and name.endswith(".json")])
+        lines = []
+        for metric, values in zip(self._metrics, totals):
+            lines.extend(metric.render(values))
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+db_query_duration = registry.register(Histogram(
+    "db_query_duration_seconds", "Time spent executing queries.", ("db_key", "query")))
+db_query_rows = registry.register(Counter(
+    "db_query_rows_total", "Rows returned or affected by queries.", ("db_key", "query")))
+db_query_errors = registry.register(Counter(
+    "db_query_errors_total", "Queries that raised an error.", ("db_key", "query")))
+db_admission_rejected = registry.register(Counter(
+    "db_admission_rejected_total", "Queries rejected because the database was saturated.", ("db_key",)))
+write_behind_rows = registry.register(Counter(
+    "write_behind_rows_total", "Rows queued, flushed or failed in write-behind buffers.", ("buffer", "state")))
+http_request_duration = registry.register(Histogram(
+    "http_request_duration_seconds", "Time spent handling requests.", ("method", "route", "status")))
@@ -0,0 +1,60 @@
+import datetime
+import decimal
+import uuid
+
+from flask import request
+
+try:
+    import msgpack
+except ImportError:  # MessagePack is only offered when the package is installed
+    msgpack = None
+
+JSON = "application/json"
+NDJSON = "application/x-ndjson"
+MSGPACK = "application/msgpack"
+_MSGPACK_ALIASES = ("application/x-msgpack",)
+
+
+def negotiated_mimetype(offered=None):
+    """
+    Encoding of the response chosen from the Accept header of the current request.
+    JSON is used when the header is missing, */* or asks for nothing we can produce.
+    :param offered: <list> Mimetypes the caller can produce, all of them when not set
+    :rtype: str
+    """
+    if offered is None:
+        offered = [JSON, NDJSON, MSGPACK]
+    if msgpack is not None and MSGPACK in offered:
+        offered = list(offered) + list(_MSGPACK_ALIASES)
+    else:
+        offered = [mimetype for mimetype in offered if mimetype != MSGPACK]
+    best = request.accept_mimetypes.best_match(offered, default=JSON)
+    return MSGPACK if best in _MSGPACK_ALIASES else best
+
+
+def ndjson_items(obj):
+    """
+    Values written one per line in NDJSON: for an Output envelope holding a list of rows,
+    the envelope without its data, then each row; any other value on a single line.
+    """
+    if isinstance(obj, dict) and isinstance(obj.get("data"), list):
+        yield {key: value for key, value in obj.items() if key != "data"}
+        for row in obj["data"]:
+            yield row
+    else:
+        yield obj
+
+
+def _msgpack_default(o):
+    if isinstance(o, decimal.Decimal):
+        return float(o)
+    if isinstance(o, (datetime.datetime, datetime.date, datetime.time)):
+        return o.isoformat()
+    if isinstance(o, uuid.UUID):
+        return str(o)
+    raise TypeError("Object of type {} is not MessagePack serializable".format(type(o).__name__))
+
+
+def msgpack_dumps(obj):
+    """:rtype: bytes"""
+    return msgpack.packb(obj, default=_msgpack_default, use_bin_type=True)
@@ -0,0 +1,199 @@
+import threading
+import time
+
+import psycopg2
+import psycopg2.extensions
+from psycopg2.pool import PoolError
+
+
+class PoolTimeout(PoolError):
+    """Raised when no connection could be checked out before the timeout."""
+
+
+def connection_dsn(db_config, connect_timeout=None, statement_timeout=None):
+    """
+    :param db_config: <dict> DATABASE entry of the config
+    :param connect_timeout: <int> Seconds to wait for the server when connecting, used unless the entry
+        has a "CONNECT_TIMEOUT"
+    :param statement_timeout: <int> Milliseconds after which the server cancels a statement, used unless
+        the entry has a "STATEMENT_TIMEOUT"
+    :rtype: str
+    """
+    dsn = "host={HOST} user={USER} password={PASSWORD} dbname={NAME}".format(**db_config)
+    connect_timeout = db_config.get("CONNECT_TIMEOUT", connect_timeout)
+    if connect_timeout:
+        dsn += " connect_timeout={:d}".format(int(connect_timeout))
+    statement_timeout = db_config.get("STATEMENT_TIMEOUT", statement_timeout)
+    if statement_timeout:
+        # Set once per session, so it costs no round trip per query
+        dsn += " options='-c statement_timeout={:d}'".format(int(statement_timeout))
+    return dsn
+
+
+class ConnectionPool:
+    """
+    Thread-safe pool of psycopg2 connections shared by the whole process.
+
+    Connections are opened lazily up to ``max_size``; ``min_size`` of them are
+    kept open even when idle, the others are closed once they stay unused for
+    more than ``idle_timeout`` seconds (checked by a background thread, so
+    this also happens without traffic). A connection idle for longer than
+    ``health_check_after`` seconds is pinged before being handed out, and
+    broken connections are replaced transparently.
+    """
+
+    def __init__(self, dsn, min_size=1, max_size=10, idle_timeout=300, checkout_timeout=30,
+                 health_check=True, health_check_after=5, connection_factory=None):
+        if min_size < 0 or max_size < 1 or min_size > max_size:
+            raise ValueError("Invalid pool size (min: {}, max: {})".format(min_size, max_size))
+        self.dsn = dsn
+        self.min_size = min_size
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.checkout_timeout = checkout_timeout
+        self.health_check = health_check
+        self.health_check_after = health_check_after
+        self.connection_factory = connection_factory
+
+        self._cond = threading.Condition()
+        self._idle = []  # (connection, last release time), most recent last
+        self._size = 0
+        self._closed = False
+        self._stop_reaper = threading.Event()
+
+        for _ in range(min_size):
+            with self._cond:
+                self._size += 1
+            self._idle.append((self._connect(), time.monotonic()))
+        if idle_timeout and max_size > min_size:
+            threading.Thread(target=self._reap_idle, name="pool-reaper", daemon=True).start()
+
+    def _connect(self):
+        try:
+            return psycopg2.connect(self.dsn, connection_factory=self.connection_factory)
+        except Exception:
+            with self._cond:
+                self._size -= 1
+                self._cond.notify()
+            raise
+
+    def _discard(self, conn):
+        try:
+            if not conn.closed:
+                conn.close()
+        finally:
+            with self._cond:
+                self._size -= 1
+                self._cond.notify()
+
+    def _evict_idle(self):
+        """Close connections idle for too long. Must be called with the lock held."""
+        if not self.idle_timeout:
+            return
+        limit = time.monotonic() - self.idle_timeout
+        # Oldest connections are at the front of the list
+        while self._idle and self._size > self.min_size and self._idle[0][1] < limit:
+            conn, _ = self._idle.pop(0)
+            self._size -= 1
+            try:
+                conn.close()
+            except psycopg2.Error:
+                pass
+
+    def _reap_idle(self):
+        # Without traffic _acquire never runs, and extra connections would stay open
+        while not self._stop_reaper.wait(max(1.0, self.idle_timeout / 2)):
+            with self._cond:
+                self._evict_idle()
+
+    def _acquire(self, deadline):
+        """
+        Take an idle connection, or reserve a slot for a new one.
+        :return: (connection, idle time) or (None, None) when the caller must open the connection
+        """
+        with self._cond:
+            while True:
+                if self._closed:
+                    raise PoolError("The connection pool is closed")
+                self._evict_idle()
+                if self._idle:
+                    conn, released_at = self._idle.pop()
+                    return conn, time.monotonic() - released_at
+                if self._size < self.max_size:
+                    self._size += 1
+                    return None, None
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise PoolTimeout(
+                        "No connection available after {}s (max size: {})".format(self.checkout_timeout,
+                                                                                  self.max_size))
+                self._cond.wait(remaining)
+
+    def _is_healthy(self, conn, idle_for):
+        if conn.closed:
+            return False
+        if not self.health_check or idle_for < self.health_check_after:
+            return True
+        try:
+            # Autocommit avoids opening a transaction (and a second round trip to close it)
+            conn.autocommit = True
+            with conn.cursor() as cursor:
+                cursor.execute("SELECT 1")
+            conn.autocommit = False
+            return True
+        except psycopg2.Error:
+            return False
+
+    def getconn(self):
+        """
+        Check out a connection, waiting up to ``checkout_timeout`` seconds when the pool is exhausted.
+        :return: Connection
+        :rtype: :class:`psycopg2.connection`
+        """
+        deadline = time.monotonic() + self.checkout_timeout
+        while True:
+            conn, idle_for = self._acquire(deadline)
+            if conn is None:
+                return self._connect()
+            if self._is_healthy(conn, idle_for):
+                return conn
+            self._discard(conn)
+
+    def putconn(self, conn, close=False):
+        """
+        Give a connection back to the pool. Any pending transaction is rolled back.
+        :param conn: <psycopg2.connection> Connection obtained from getconn
+        :param close: <bool> If set to true, the connection is closed instead of being reused
+        """
+        if not close and not conn.closed:
+            try:
+                if conn.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                    conn.rollback()
+            except psycopg2.Error:
+                close = True
+        if close or conn.closed or self._closed:
+            self._discard(conn)
+            return
+        with self._cond:
+            self._evict_idle()
+            self._idle.append((conn, time.monotonic()))
+            self._cond.notify()
+
+    def closeall(self):
+        """Close every idle connection; connections still checked out are closed when given back."""
+        self._stop_reaper.set()
+        with self._cond:
+            self._closed = True
+            idle, self._idle = self._idle, []
+            self._size -= len(idle)
+            self._cond.notify_all()
+        for conn, _ in idle:
+            try:
+                conn.close()
+            except psycopg2.Error:
+                pass
+
+    @property
+    def stats(self):
+        with self._cond:
+            return {"size": self._size, "idle": len(self._idle), "in_use": self._size - len(self._idle)}
@@ -0,0 +1,317 @@
+import atexit
+import logging
+import os
+import random
+import shutil
+import signal
+import socket
+import tempfile
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+
+from werkzeug.serving import BaseWSGIServer, WSGIRequestHandler
+
+logger = logging.getLogger(__name__)
+
+
+def _drop_process_state():
+    from modules.lib import aiodb, db
+    from modules.lib.query_cache import query_cache
+
+    # The log listener is restarted by modules.lib.logs itself, in the child only
+    db.close_pools()
+    # Id blocks reserved by the parent would be handed out twice, and its
+    # write-behind threads do not exist in the worker
+    db._id_allocators.clear()
+    db._write_behind.clear()
+    aiodb._pools.clear()
+    query_cache.clear()
+
+
+def default_on_starting(app):
+    """Runs in the master before the first fork: nothing it opened may leak into
+    the workers, and their metrics are shared through the "METRICS_DIR" directory
+    of the PREFORK config (a temporary one by default)."""
+    from modules.lib.metrics import registry
+
+    _drop_process_state()
+    directory = (app.config.get("PREFORK") or {}).get("METRICS_DIR")
+    if directory is None:
+        directory = tempfile.mkdtemp(prefix="metrics-")
+        # Workers leave with os._exit: only the master removes it
+        atexit.register(shutil.rmtree, directory, True)
+    registry.use_directory(directory)
+
+
+def default_post_fork(app):
+    """Drop the per-process state a worker must not share with its parent:
+    connection pools and caches are rebuilt lazily inside the worker, which
+    also starts publishing its metrics."""
+    from modules.lib.metrics import registry
+
+    _drop_process_state()
+    registry.start_writer((app.config.get("PREFORK") or {}).get("METRICS_INTERVAL", 5))
+
+
+def default_worker_exit(app):
+    """Workers leave with os._exit, which skips atexit handlers: write what is
+    still buffered (write-behind rows, log records, metrics) before exiting."""
+    from modules.lib import db
+    from modules.lib.logs import stop_listener
+    from modules.lib.metrics import registry
+
+    db.close_write_behind()
+    registry.stop_writer()
+    stop_listener()
+
+
+def default_child_exit(app, pid):
+    """Runs in the master once a worker exited: its metrics are kept in the archive."""
+    from modules.lib.metrics import registry
+
+    registry.collect(pid)
+
+
+class _RequestHandler(WSGIRequestHandler):
+    # One request per connection: a worker can then stop without waiting for idle keep-alive clients
+    protocol_version = "HTTP/1.0"
+
+
+class _WorkerServer(BaseWSGIServer):
+    """WSGI server of a worker: connections accepted on the inherited socket
+    are handled by a fixed pool of threads. A worker whose threads are all busy
+    stops accepting, leaving new connections to the other workers."""
+
+    def __init__(self, host, port, app, fd, threads):
+        self.executor = ThreadPoolExecutor(max_workers=threads)
+        self._slots = threading.BoundedSemaphore(threads)
+        super(_WorkerServer, self).__init__(host, port, app, handler=_RequestHandler, fd=fd)
+        # Workers wake up together on a shared socket: accept fails instead of
+        # blocking the serve loop when another worker took the connection
+        self.socket.setblocking(False)
+        self.multithread = threads > 1
+        self.multiprocess = True
+
+    def get_request(self):
+        # The serve loop ignores OSError and polls again, checking for shutdown meanwhile
+        if not self._slots.acquire(timeout=0.5):
+            raise OSError("Every thread of the worker is busy")
+        try:
+            request, client_address = super(_WorkerServer, self).get_request()
+        except OSError:
+            self._slots.release()
+            raise
+        request.setblocking(True)
+        return request, client_address
+
+    def shutdown_request(self, request):
+        # Called once for every accepted connection, whatever happened to it
+        try:
+            super(_WorkerServer, self).shutdown_request(request)
+        finally:
+            self._slots.release()
+
+    def process_request(self, request, client_address):
+        self.executor.submit(self._process_request_thread, request, client_address)
+
+    def _process_request_thread(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+
+
+class PreforkServer:
+    """
+    Production launcher: a master process binding the listening socket and
+    forking ``workers`` processes that serve it with ``threads`` threads each.
+
+    - SIGTERM / SIGINT: graceful stop, workers finish their requests in progress
+    - SIGHUP: graceful restart, a new set of workers is started before the old one stops
+    - A worker is recycled after ``max_requests`` requests (plus a random jitter,
+      so they do not all restart at once)
+    - ``on_starting(app)`` runs in the master before the first fork
+    - ``post_fork(app)`` runs in each worker before it serves anything, so DB
+      connections and caches are created per worker, never inherited
+    - ``worker_exit(app)`` runs in each worker once it stopped serving
+    - ``child_exit(app, pid)`` runs in the master once a worker exited
+
+    With ``reuse_port``, each worker binds its own SO_REUSEPORT socket and the
+    kernel balances connections between them (connections still queued on the
+    socket of a recycled worker are lost); otherwise they share the master's.
+    """
+
+    def __init__(self, app, host="0.0.0.0", port=8431, workers=4, threads=8, max_requests=0,
+                 max_requests_jitter=0, reuse_port=False, graceful_timeout=30, backlog=2048,
+                 on_starting=default_on_starting, post_fork=default_post_fork, worker_exit=default_worker_exit,
+                 child_exit=default_child_exit):
+        self.app = app
+        self.host = host
+        self.port = port
+        self.workers = workers
+        self.threads = threads
+        self.max_requests = max_requests
+        self.max_requests_jitter = max_requests_jitter
+        self.reuse_port = reuse_port
+        self.graceful_timeout = graceful_timeout
+        self.backlog = backlog
+        self.on_starting = on_starting
+        self.post_fork = post_fork
+        self.worker_exit = worker_exit
+        self.child_exit = child_exit
+
+        self._socket = None
+        self._children = {}  # pid -> generation
+        self._generation = 0
+        self._running = True
+        self._reload = False
+
+    def _bind(self):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if self.reuse_port:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        sock.bind((self.host, self.port))
+        sock.listen(self.backlog)
+        sock.set_inheritable(True)
+        return sock
+
+    def run(self):
+        if not self.reuse_port:
+            self._socket = self._bind()
+        self.on_starting(self.app)
+
+        signal.signal(signal.SIGTERM, self._on_stop)
+        signal.signal(signal.SIGINT, self._on_stop)
+        signal.signal(signal.SIGHUP, self._on_reload)
+        logger.info("Master %s listening on %s:%s (%s workers x %s threads)", os.getpid(), self.host, self.port,
+                    self.workers, self.threads)
+
+        for _ in range(self.workers):
+            self._spawn()
+        while self._running:
+            if self._reload:
+                self._reload = False
+                self._restart_workers()
+            self._reap()
+            # Replace workers that exited (recycled or crashed)
+            current = sum(1 for generation in self._children.values() if generation == self._generation)
+            for _ in range(self.workers - current):
+                self._spawn()
+            time.sleep(0.5)
+        self._stop_workers(list(self._children))
+
+    def _on_stop(self, signum, frame):
+        self._running = False
+
+    def _on_reload(self, signum, frame):
+        self._reload = True
+
+    def _reap(self):
+        while self._children:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return
+            if pid == 0:
+                return
+            self._children.pop(pid, None)
+            logger.info("Worker %s exited (status %s)", pid, status)
+            try:
+                self.child_exit(self.app, pid)
+            except Exception:
+                logger.exception("Exit hook of worker %s failed", pid)
+
+    def _restart_workers(self):
+        previous = list(self._children)
+        self._generation += 1
+        for _ in range(self.workers):
+            self._spawn()
+        self._stop_workers(previous)
+
+    def _stop_workers(self, pids):
+        for pid in pids:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        deadline = time.monotonic() + self.graceful_timeout
+        while any(pid in self._children for pid in pids) and time.monotonic() < deadline:
+            self._reap()
+            time.sleep(0.1)
+        for pid in pids:
+            if pid in self._children:
+                logger.warning("Worker %s did not stop in %ss, killing it", pid, self.graceful_timeout)
+                try:
+                    os.kill(pid, signal.SIGKILL)
+                except ProcessLookupError:
+                    pass
+        self._reap()
+
+    def _spawn(self):
+        # Signals are held until the worker replaced the master's handlers, which
+        # would only change the worker's copy of _running
+        stop_signals = {signal.SIGTERM, signal.SIGINT, signal.SIGHUP}
+        signal.pthread_sigmask(signal.SIG_BLOCK, stop_signals)
+        pid = os.fork()
+        if pid:
+            signal.pthread_sigmask(signal.SIG_UNBLOCK, stop_signals)
+            self._children[pid] = self._generation
+            return
+        # Worker process: until _serve installs its own handlers, a stop request is only recorded
+        exit_code = 0
+        stopping = []
+        try:
+            signal.signal(signal.SIGHUP, signal.SIG_IGN)
+            signal.signal(signal.SIGTERM, lambda signum, frame: stopping.append(signum))
+            signal.signal(signal.SIGINT, lambda signum, frame: stopping.append(signum))
+            signal.pthread_sigmask(signal.SIG_UNBLOCK, stop_signals)
+            self.post_fork(self.app)
+            self._serve(stopping)
+        except Exception:
+            logger.exception("Worker %s crashed", os.getpid())
+            exit_code = 1
+        finally:
+            try:
+                self.worker_exit(self.app)
+            except Exception:
+                logger.exception("Worker %s exit hook failed", os.getpid())
+                exit_code = 1
+            os._exit(exit_code)
+
+    def _serve(self, stopping):
+        sock = self._socket if self._socket is not None else self._bind()
+        max_requests = self.max_requests
+        if max_requests and self.max_requests_jitter:
+            max_requests += random.randint(0, self.max_requests_jitter)
+
+        handled = [0]
+        lock = threading.Lock()
+        server = None
+
+        def stop():
+            threading.Thread(target=server.shutdown, daemon=True).start()
+
+        def counting_app(environ, start_response):
+            with lock:
+                handled[0] += 1
+                recycle = max_requests and handled[0] == max_requests
+            if recycle:
+                logger.info("Worker %s recycled after %s requests", os.getpid(), max_requests)
+                stop()
+            return self.app(environ, start_response)
+
+        server = _WorkerServer(self.host, self.port, counting_app, sock.fileno(), self.threads)
+        signal.signal(signal.SIGTERM, lambda signum, frame: stop())
+        signal.signal(signal.SIGINT, lambda signum, frame: stop())
+        try:
+            if not stopping:
+                server.serve_forever()
+        finally:
+            # Requests in progress are completed before the worker exits
+            server.executor.shutdown(wait=True)
+            server.server_close()
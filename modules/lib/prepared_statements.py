@@ -0,0 +1,160 @@
+import hashlib
+import re
+import threading
+
+from collections import OrderedDict
+
+import psycopg2
+import psycopg2.extensions
+
+# %(name)s, %s and the %% escape, as understood by psycopg2
+_PLACEHOLDER = re.compile(r"%\((\w+)\)s|%s|%%")
+_PREPARABLE = ("SELECT", "INSERT", "UPDATE", "DELETE", "VALUES", "WITH")
+# Placeholders psycopg2 fills with SQL syntax rather than a value: "IN %s" with a tuple,
+# "IS %s" with None/True/False. As $n parameters of PREPARE, they are syntax errors
+_SYNTAX_PLACEHOLDER = re.compile(r"\b(?:IN|IS(?:\s+NOT)?)\s*%(?:\(\w+\))?s", re.IGNORECASE)
+
+_stats = {"hits": 0, "misses": 0, "evictions": 0}
+_stats_lock = threading.Lock()
+
+
+class StatementConnection(psycopg2.extensions.connection):
+    """psycopg2 connection carrying the cache of the statements prepared on its session."""
+
+    def __init__(self, *args, **kwargs):
+        super(StatementConnection, self).__init__(*args, **kwargs)
+        self.prepared_statements = OrderedDict()
+        # Statements the server refused to prepare, run with a plain execute from then on
+        self.unpreparable_statements = set()
+
+
+def _count(key):
+    with _stats_lock:
+        _stats[key] += 1
+
+
+def prepared_statement_stats():
+    """
+    Process-wide counters of the prepared statement cache.
+    :return: hits, misses, evictions and hit rate
+    :rtype: :class:`dict`
+    """
+    with _stats_lock:
+        stats = dict(_stats)
+    lookups = stats["hits"] + stats["misses"]
+    stats["hit_rate"] = stats["hits"] / lookups if lookups else 0.0
+    return stats
+
+
+def _to_server_placeholders(query):
+    """
+    Rewrites the psycopg2 placeholders of a query into $n ones.
+    :return: (query for PREPARE, EXECUTE arguments template) or (None, None) if the placeholders are mixed
+             or stand for SQL syntax ("IN %s", "IS %s")
+    """
+    if _SYNTAX_PLACEHOLDER.search(query):
+        return None, None
+    names = []
+    positional = [0]
+    kinds = set()
+
+    def replace(match):
+        if match.group(0) == "%%":
+            return "%"
+        if match.group(1) is not None:
+            kinds.add("named")
+            if match.group(1) not in names:
+                names.append(match.group(1))
+            return "${}".format(names.index(match.group(1)) + 1)
+        kinds.add("positional")
+        positional[0] += 1
+        return "${}".format(positional[0])
+
+    server_query = _PLACEHOLDER.sub(replace, query)
+    if len(kinds) > 1:
+        return None, None
+    if names:
+        arguments = ", ".join("%({})s".format(name) for name in names)
+    else:
+        arguments = ", ".join(["%s"] * positional[0])
+    return server_query, arguments
+
+
+def _has_row_params(query_params):
+    # Tuples are adapted to a row "(a, b)", which EXECUTE cannot bind to a parameter
+    if isinstance(query_params, dict):
+        query_params = query_params.values()
+    return any(isinstance(value, tuple) for value in query_params or ())
+
+
+def _prepare(cursor, name, server_query):
+    """
+    PREPARE inside a savepoint, so a statement the server refuses does not abort the transaction.
+    :return: True if the statement was prepared
+    """
+    if cursor.connection.autocommit:
+        try:
+            cursor.execute("PREPARE {} AS {}".format(name, server_query))
+            return True
+        except psycopg2.Error:
+            return False
+    cursor.execute("SAVEPOINT ps_prepare")
+    try:
+        cursor.execute("PREPARE {} AS {}".format(name, server_query))
+    except psycopg2.Error:
+        cursor.execute("ROLLBACK TO SAVEPOINT ps_prepare")
+        return False
+    cursor.execute("RELEASE SAVEPOINT ps_prepare")
+    return True
+
+
+def execute_prepared(cursor, query, query_params, max_size):
+    """
+    Runs the query with EXECUTE, preparing it first if this connection has not seen it yet.
+    Statements PREPARE cannot handle (DDL, several statements, "IN %s"...) are executed as usual.
+    :param cursor: <psycopg2.cursor> Cursor of a StatementConnection
+    :param query: <str> The query string, already properly formatted
+    :param query_params: <dict|tuple> the query parameters to be used, None to run the text as is
+    :param max_size: <int> Maximum number of statements kept prepared on the connection
+    """
+    statements = getattr(cursor.connection, "prepared_statements", None)
+    query_text = query.strip().rstrip(";").strip()
+    if (statements is None or ";" in query_text or _has_row_params(query_params)
+            or query_text.split(None, 1)[0].upper() not in _PREPARABLE):
+        cursor.execute(query, query_params)
+        return
+
+    # Without parameters psycopg2 sends the text as is: "%" is neither a placeholder nor an escape
+    # there, so the text is prepared unchanged, under another name than its rewritten form
+    verbatim = query_params is None
+    name = "ps_" + hashlib.sha1((("verbatim:" if verbatim else "") + query_text).encode("utf-8")).hexdigest()[:20]
+    if name in cursor.connection.unpreparable_statements:
+        cursor.execute(query, query_params)
+        return
+    if name in statements:
+        statements.move_to_end(name)
+        arguments = statements[name]
+        _count("hits")
+    else:
+        if verbatim:
+            server_query, arguments = query_text, ""
+        else:
+            server_query, arguments = _to_server_placeholders(query_text)
+        if server_query is None:
+            cursor.execute(query, query_params)
+            return
+        _count("misses")
+        while len(statements) >= max_size:
+            evicted, _ = statements.popitem(last=False)
+            cursor.execute("DEALLOCATE {}".format(evicted))
+            _count("evictions")
+        if not _prepare(cursor, name, server_query):
+            cursor.connection.unpreparable_statements.add(name)
+            cursor.execute(query, query_params)
+            return
+        statements[name] = arguments
+
+    if arguments:
+        cursor.execute("EXECUTE {} ({})".format(name, arguments), query_params)
+    else:
+        cursor.execute("EXECUTE {}".format(name))
@@ -0,0 +1,144 @@
+import pickle
+import re
+import threading
+import time
+
+from collections import OrderedDict
+from functools import lru_cache
+
+_WRITTEN_TABLE = re.compile(
+    r"\b(?:INSERT\s+INTO|UPDATE|DELETE\s+FROM|TRUNCATE(?:\s+TABLE)?|COPY|MERGE\s+INTO)\s+(?:ONLY\s+)?([\w.\"]+)",
+    re.IGNORECASE
+)
+_READ_TABLE = re.compile(r"\b(?:FROM|JOIN)\s+(?:ONLY\s+)?([\w.\"]+)", re.IGNORECASE)
+
+
+def _table_name(name):
+    # Schema and quotes are dropped: invalidating too much is harmless, missing a table is not
+    return name.replace('"', "").rsplit(".", 1)[-1].lower()
+
+
+@lru_cache(maxsize=1024)
+def written_tables(query):
+    """Names of the tables an INSERT/UPDATE/DELETE/TRUNCATE/COPY query writes to."""
+    return frozenset(_table_name(t) for t in _WRITTEN_TABLE.findall(query))
+
+
+@lru_cache(maxsize=1024)
+def read_tables(query):
+    """Names of the tables found after FROM/JOIN in a query."""
+    return frozenset(_table_name(t) for t in _READ_TABLE.findall(query) if t.upper() != "SELECT")
+
+
+def _freeze(value):
+    if isinstance(value, dict):
+        return tuple(sorted((k, _freeze(v)) for k, v in value.items()))
+    if isinstance(value, (list, tuple)):
+        return tuple(_freeze(v) for v in value)
+    return value
+
+
+class QueryCache:
+    """
+    In-process cache of query results with a TTL per entry and a global memory budget.
+    The least recently used entries are evicted once the budget is exceeded, and every
+    entry is tagged with the tables it reads so writes to those tables invalidate it.
+    Values are stored pickled: every hit gets its own copy, which the caller is free to modify.
+    """
+
+    def __init__(self, max_bytes=64 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # key -> (expires_at, size, tags, pickled value)
+        self._tags = {}  # (db_key, table) -> set of keys
+        self._bytes = 0
+        self._stats = {"hits": 0, "misses": 0, "evictions": 0, "invalidations": 0}
+
+    @staticmethod
+    def make_key(db_key, query, query_params, shape=None):
+        """
+        :param shape: Anything telling apart the forms the result of the same query is cached in
+            (one row, every row...), so each form gets its own entry
+        :return: The cache key, or None when the parameters cannot be hashed
+        """
+        key = (db_key, query, _freeze(query_params), shape)
+        try:
+            hash(key)
+        except TypeError:
+            return None
+        return key
+
+    def get(self, key):
+        """
+        :return: (True, value) on a hit, (False, None) otherwise
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] < time.monotonic():
+                self._remove(key)
+                entry = None
+            if entry is None:
+                self._stats["misses"] += 1
+                return False, None
+            self._entries.move_to_end(key)
+            self._stats["hits"] += 1
+        return True, pickle.loads(entry[3])
+
+    def set(self, key, value, ttl, tables):
+        value = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        size = len(value)
+        if size > self.max_bytes:
+            return
+        tags = frozenset((key[0], _table_name(t)) for t in tables)
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (time.monotonic() + ttl, size, tags, value)
+            self._bytes += size
+            for tag in tags:
+                self._tags.setdefault(tag, set()).add(key)
+            while self._bytes > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+                self._stats["evictions"] += 1
+
+    def _remove(self, key):
+        """Must be called with the lock held."""
+        _, size, tags, _ = self._entries.pop(key)
+        self._bytes -= size
+        for tag in tags:
+            keys = self._tags.get(tag)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._tags[tag]
+
+    def invalidate_tables(self, db_key, tables):
+        """Drop every entry of db_key tagged with one of the tables."""
+        with self._lock:
+            for table in tables:
+                for key in list(self._tags.get((db_key, _table_name(table)), ())):
+                    if key in self._entries:
+                        self._remove(key)
+                        self._stats["invalidations"] += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._tags.clear()
+            self._bytes = 0
+
+    def stats(self):
+        """
+        :return: hits, misses, evictions, invalidations, hit rate, number of entries and bytes used
+        :rtype: :class:`dict`
+        """
+        with self._lock:
+            stats = dict(self._stats)
+            stats["entries"] = len(self._entries)
+            stats["bytes"] = self._bytes
+        lookups = stats["hits"] + stats["misses"]
+        stats["hit_rate"] = stats["hits"] / lookups if lookups else 0.0
+        return stats
+
+
+query_cache = QueryCache()
@@ -0,0 +1,79 @@
+import re
+import threading
+import time
+
+from functools import lru_cache
+
+# Seconds the replica is behind the primary; 0 when it has replayed everything it received
+REPLICA_LAG_QUERY = """
+    SELECT CASE
+        WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+        ELSE COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0)
+    END AS lag;
+"""
+
+# Reads a standby refuses: sequence and transaction id functions, locks
+_PRIMARY_ONLY = re.compile(
+    r"\b(?:nextval|setval|currval|lastval|txid_current|pg_current_xact_id|pg_(?:try_)?advisory_\w+)\s*\("
+    r"|\bFOR\s+(?:NO\s+KEY\s+)?UPDATE\b|\bFOR\s+(?:KEY\s+)?SHARE\b",
+    re.IGNORECASE
+)
+
+
+@lru_cache(maxsize=1024)
+def requires_primary(query):
+    """True when a query that writes to no table still cannot run on a read replica
+    (nextval, SELECT ... FOR UPDATE...). Functions writing to the database cannot be
+    recognized: their callers pass use_primary=True."""
+    return _PRIMARY_ONLY.search(query) is not None
+
+
+class ReplicaSet:
+    """
+    Replicas of one database key: smooth weighted round-robin among the
+    replicas whose last measured replication lag is under ``max_lag``.
+    Lags are measured at most once per ``check_interval`` seconds per replica.
+    """
+
+    def __init__(self, weights, max_lag=10, check_interval=5):
+        self.weights = list(weights)
+        self.max_lag = max_lag
+        self.check_interval = check_interval
+        self._current = [0] * len(self.weights)
+        self._lags = [0.0] * len(self.weights)
+        self._checked_at = [None] * len(self.weights)
+        self._lock = threading.Lock()
+
+    def due_for_check(self):
+        """
+        Replicas whose lag must be measured now. They are marked as checked, so
+        concurrent requests do not measure them at the same time.
+        """
+        now = time.monotonic()
+        with self._lock:
+            due = [i for i, checked_at in enumerate(self._checked_at)
+                   if checked_at is None or now - checked_at > self.check_interval]
+            for i in due:
+                self._checked_at[i] = now
+        return due
+
+    def set_lag(self, index, lag):
+        """:param lag: <float> Seconds, or None when the replica could not be reached"""
+        with self._lock:
+            self._lags[index] = float("inf") if lag is None else lag
+
+    def choose(self):
+        """
+        :return: Index of the replica to use, or None if none is usable
+        """
+        with self._lock:
+            candidates = [i for i, lag in enumerate(self._lags) if lag <= self.max_lag and self.weights[i] > 0]
+            if not candidates:
+                return None
+            total = 0
+            for i in candidates:
+                self._current[i] += self.weights[i]
+                total += self.weights[i]
+            chosen = max(candidates, key=lambda i: self._current[i])
+            self._current[chosen] -= total
+            return chosen
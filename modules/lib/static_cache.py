@@ -0,0 +1,116 @@
+import gzip
+import hashlib
+import mimetypes
+import os
+import threading
+import time
+
+from flask import Response, request
+
+# Types worth compressing; images and fonts are already compressed
+_COMPRESSIBLE = ("text/", "application/javascript", "application/json", "application/xml", "image/svg+xml")
+
+
+class StaticAsset:
+    __slots__ = ("path", "mtime", "body", "gzip_body", "mimetype", "etag")
+
+    def __init__(self, path, mtime, body, mimetype):
+        self.path = path
+        self.mtime = mtime
+        self.body = body
+        self.mimetype = mimetype
+        self.etag = hashlib.sha1(body).hexdigest()
+        self.gzip_body = None
+        if mimetype.startswith(_COMPRESSIBLE) and len(body) > 512:
+            compressed = gzip.compress(body, 9)
+            if len(compressed) < len(body):
+                self.gzip_body = compressed
+
+
+class StaticAssetCache:
+    """
+    In-memory copy of a static tree (the Sphinx documentation), scanned once into a manifest.
+    Assets are served from memory, gzip-precompressed when the client accepts it, and reloaded
+    only when their mtime changed; files are stat'ed at most once per ``check_interval`` seconds.
+    """
+
+    def __init__(self, root, check_interval=2.0):
+        self.root = root
+        self.check_interval = check_interval
+        self._lock = threading.Lock()
+        self._manifest = {}
+        self._checked_at = {}
+        self._scanned_at = 0.0
+        self.scan()
+
+    def _load(self, relative_path, mtime):
+        path = os.path.join(self.root, relative_path)
+        with open(path, "rb") as f:
+            body = f.read()
+        mimetype = mimetypes.guess_type(path)[0] or "application/octet-stream"
+        return StaticAsset(path, mtime, body, mimetype)
+
+    def scan(self):
+        """(Re)build the manifest from the files on disk, reusing unchanged assets."""
+        manifest = {}
+        for directory, _, files in os.walk(self.root):
+            for name in files:
+                path = os.path.join(directory, name)
+                relative_path = os.path.relpath(path, self.root).replace(os.sep, "/")
+                mtime = os.stat(path).st_mtime
+                asset = self._manifest.get(relative_path)
+                manifest[relative_path] = asset if asset and asset.mtime == mtime else self._load(relative_path, mtime)
+        with self._lock:
+            self._manifest = manifest
+            self._checked_at = {}
+            self._scanned_at = time.monotonic()
+
+    @property
+    def has_files(self):
+        return bool(self._manifest)
+
+    def get(self, relative_path):
+        """
+        :return: The asset, reloaded if its file changed, or None if it does not exist
+        """
+        now = time.monotonic()
+        asset = self._manifest.get(relative_path)
+        if asset is None:
+            # Unknown files trigger a rescan, at most once per interval
+            if self.check_interval and now - self._scanned_at > self.check_interval:
+                self.scan()
+                asset = self._manifest.get(relative_path)
+            return asset
+
+        if self.check_interval and now - self._checked_at.get(relative_path, 0.0) > self.check_interval:
+            self._checked_at[relative_path] = now
+            try:
+                mtime = os.stat(asset.path).st_mtime
+            except OSError:
+                with self._lock:
+                    self._manifest.pop(relative_path, None)
+                return None
+            if mtime != asset.mtime:
+                asset = self._load(relative_path, mtime)
+                with self._lock:
+                    self._manifest[relative_path] = asset
+        return asset
+
+    def send(self, relative_path):
+        """
+        :return: The response serving the asset for the current request, or None if it does not exist
+        :rtype: :class:`flask.Response`
+        """
+        asset = self.get(relative_path)
+        if asset is None:
+            return None
+        if asset.gzip_body is not None and "gzip" in request.accept_encodings:
+            response = Response(asset.gzip_body, mimetype=asset.mimetype)
+            response.headers["Content-Encoding"] = "gzip"
+            response.set_etag(asset.etag + "-gz")
+        else:
+            response = Response(asset.body, mimetype=asset.mimetype)
+            response.set_etag(asset.etag)
+        response.vary.add("Accept-Encoding")
+        response.last_modified = asset.mtime
+        return response.make_conditional(request)
@@ -0,0 +1,123 @@
+import logging
+import queue
+import threading
+import time
+
+from modules.lib import metrics
+
+logger = logging.getLogger(__name__)
+
+_STOP = object()
+
+
+class WriteBehindBuffer:
+    """
+    Queue of rows written to the database by a background thread.
+
+    Rows are coalesced into batches given to ``flush_rows(rows)``: a batch is
+    flushed once it holds ``max_batch`` rows or ``flush_interval`` seconds after
+    its first row. When ``max_queue`` rows are already waiting, put blocks up to
+    ``put_timeout`` seconds, then raises queue.Full (backpressure). Rows of a
+    failed batch are dropped and counted as failed, so a row whose columns
+    differ from those of the first row is refused by put instead.
+    """
+
+    def __init__(self, name, flush_rows, max_batch=500, flush_interval=1.0, max_queue=10000, put_timeout=0.5):
+        self.name = name
+        self.flush_rows = flush_rows
+        self.max_batch = max_batch
+        self.flush_interval = flush_interval
+        self.put_timeout = put_timeout
+
+        self._queue = queue.Queue(max_queue)
+        self._lock = threading.Lock()
+        self._thread = None
+        self._closed = False
+        self.columns = None  # keys of the first row, every row must have the same
+        self.queued = 0
+        self.flushed = 0
+        self.failed = 0
+
+    def put(self, row):
+        """
+        :param row: <dict> Row to insert
+        :raise ValueError: The row does not have the columns of the first row
+        :raise queue.Full: The queue stayed full for put_timeout seconds
+        """
+        with self._lock:
+            if self._closed:
+                raise RuntimeError("The write-behind buffer {} is closed".format(self.name))
+            if self.columns is None:
+                self.columns = frozenset(row)
+            elif self.columns.symmetric_difference(row):
+                raise ValueError("Row columns {} differ from those of {} ({})".format(
+                    sorted(row), self.name, sorted(self.columns)))
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="write-behind-{}".format(self.name),
+                                                daemon=True)
+                self._thread.start()
+        self._queue.put(row, timeout=self.put_timeout)
+        self._count("queued", 1)
+
+    def _count(self, state, amount):
+        with self._lock:
+            setattr(self, state, getattr(self, state) + amount)
+        metrics.write_behind_rows.inc(self.name, state, amount=amount)
+
+    def _run(self):
+        stop = False
+        while not stop:
+            item = self._queue.get()
+            if item is _STOP:
+                self._queue.task_done()
+                break
+            batch = [item]
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.max_batch:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    item = self._queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                if item is _STOP:
+                    self._queue.task_done()
+                    stop = True
+                    break
+                batch.append(item)
+            self._flush(batch)
+
+    def _flush(self, batch):
+        try:
+            self.flush_rows(batch)
+            self._count("flushed", len(batch))
+        except Exception:
+            logger.exception("Write-behind flush of %s rows into %s failed", len(batch), self.name)
+            self._count("failed", len(batch))
+        finally:
+            for _ in batch:
+                self._queue.task_done()
+
+    def flush(self):
+        """Wait until every row queued so far is written (or failed)."""
+        if self._thread is not None:
+            self._queue.join()
+
+    def close(self, timeout=30):
+        """Write the queued rows and stop the thread; later puts are refused."""
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            thread = self._thread
+        if thread is not None and thread.is_alive():
+            # Queued after every pending row, so they are flushed first
+            self._queue.put(_STOP)
+            thread.join(timeout)
+
+    @property
+    def stats(self):
+        with self._lock:
+            return {"queued": self.queued, "flushed": self.flushed, "failed": self.failed,
+                    "pending": self._queue.qsize()}
@@ -3,9 +3,23 @@
 
 import os
 from modules.app import create_app
+from modules.lib.prefork import PreforkServer
 
 application = create_app(os.environ.get("APP_NAME", os.path.basename(os.path.dirname(__file__))),
                          os.environ.get("ENV", "DEV"))
 
 if __name__ == "__main__":
-    application.run("0.0.0.0", port=8431)
+    prefork = application.config.get("PREFORK")
+    if prefork:
+        PreforkServer(
+            application, "0.0.0.0", port=8431,
+            workers=prefork.get("WORKERS", 4),
+            threads=prefork.get("THREADS", 8),
+            max_requests=prefork.get("MAX_REQUESTS", 0),
+            max_requests_jitter=prefork.get("MAX_REQUESTS_JITTER", 0),
+            reuse_port=prefork.get("REUSE_PORT", False),
+            graceful_timeout=prefork.get("GRACEFUL_TIMEOUT", 30),
+        ).run()
+    else:
+        # Flask's development server
+        application.run("0.0.0.0", port=8431)